@@ -1,8 +1,12 @@
-from __future__ import print_function
+from __future__ import print_function, division
 
 from six.moves import cPickle as pickle
 import numpy as np
 import os
+import json
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 try:
     from scipy.misc import imread
 except:
@@ -18,18 +22,219 @@ def load_pickle(f):
         return  pickle.load(f, encoding='latin1')
     raise ValueError("invalid python version: {}".format(version))
 
-def load_CIFAR_batch(filename):
+def load_CIFAR_batch(filename, dtype="float"):
   """ load single batch of cifar """
   with open(filename, 'rb') as f:
     datadict = load_pickle(f)
     X = datadict['data']
     Y = datadict['labels']
-    X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype("float")
+    X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype(dtype)
     Y = np.array(Y)
     return X, Y
 
-def load_CIFAR10(ROOT):
-  """ load all of cifar """
+class ImageStats(object):
+  """
+  Streaming statistics of a set of images, accumulated one chunk of images
+  at a time so that only a single chunk is ever converted to float.
+
+  Chunk moments are merged with the pairwise update of Chan et al., which
+  stays accurate over many chunks where accumulating raw sums of squares
+  loses precision.
+
+  Example usage:
+
+  stats = ImageStats(channel_axis=-1)
+  for start in range(0, N, 1000):
+    stats.update(X[start:start + 1000])
+  mean_image = stats.result()['mean_image']
+  """
+
+  def __init__(self, channel_axis=-1):
+    """
+    - channel_axis: Axis of each chunk (N, ...) holding the color channels.
+    """
+    self.channel_axis = channel_axis
+    self.num_images = 0
+    self.mean_image = None
+    self.channel_count = 0
+    self.channel_mean = None
+    self.channel_m2 = None
+    self.channel_min = None
+    self.channel_max = None
+
+  def update(self, chunk):
+    """
+    Add a chunk of images of shape (N, ...) to the statistics.
+    """
+    chunk = np.asarray(chunk, dtype=np.float64)
+    n = chunk.shape[0]
+    if n == 0:
+      return
+    channel_axis = self.channel_axis % chunk.ndim
+    other_axes = tuple(a for a in range(chunk.ndim) if a != channel_axis)
+    if self.mean_image is None:
+      num_channels = chunk.shape[channel_axis]
+      self.mean_image = np.zeros(chunk.shape[1:])
+      self.channel_mean = np.zeros(num_channels)
+      self.channel_m2 = np.zeros(num_channels)
+      self.channel_min = np.full(num_channels, np.inf)
+      self.channel_max = np.full(num_channels, -np.inf)
+
+    total = self.num_images + n
+    self.mean_image += (chunk.mean(axis=0) - self.mean_image) * (n / total)
+    self.num_images = total
+
+    count = chunk.size // self.channel_mean.shape[0]
+    shape = [1] * chunk.ndim
+    shape[channel_axis] = -1
+    mean = chunk.mean(axis=other_axes)
+    m2 = np.sum((chunk - mean.reshape(shape)) ** 2, axis=other_axes)
+    delta = mean - self.channel_mean
+    total = self.channel_count + count
+    self.channel_mean += delta * (count / total)
+    self.channel_m2 += m2 + delta ** 2 * (self.channel_count * count / total)
+    self.channel_count = total
+    self.channel_min = np.minimum(self.channel_min, chunk.min(axis=other_axes))
+    self.channel_max = np.maximum(self.channel_max, chunk.max(axis=other_axes))
+
+  def result(self):
+    """
+    Returns a dictionary with the following entries:
+    - num_images: Number of images seen
+    - mean_image: Array of the shape of one image giving the mean image
+    - channel_mean, channel_std: Arrays of shape (C,) giving the mean and
+      standard deviation of each color channel over all pixels
+    - channel_min, channel_max: Arrays of shape (C,) giving the smallest and
+      largest value of each color channel
+    """
+    return {
+      'num_images': self.num_images,
+      'mean_image': self.mean_image,
+      'channel_mean': self.channel_mean,
+      'channel_std': np.sqrt(self.channel_m2 / self.channel_count),
+      'channel_min': self.channel_min,
+      'channel_max': self.channel_max,
+    }
+
+
+def compute_image_stats(X, channel_axis=-1, chunk_size=1000):
+  """
+  Compute the statistics described in ImageStats.result for the images in
+  X, which may be a uint8 np.memmap, in one pass of chunk_size images.
+  """
+  stats = ImageStats(channel_axis=channel_axis)
+  for start in range(0, X.shape[0], chunk_size):
+    stats.update(X[start:start + chunk_size])
+  return stats.result()
+
+
+def save_image_stats(filename, stats):
+  """ save a dictionary returned by ImageStats.result to a .npz file """
+  with open(filename + '.tmp', 'wb') as f:
+    np.savez(f, **stats)
+  os.rename(filename + '.tmp', filename)
+
+
+def load_image_stats(filename, X=None, channel_axis=-1, chunk_size=1000):
+  """
+  Load image statistics saved by save_image_stats. If filename does not
+  exist and images X are given, compute their statistics with
+  compute_image_stats and save them to filename for next time.
+  """
+  if not os.path.isfile(filename) and X is not None:
+    save_image_stats(filename, compute_image_stats(X, channel_axis, chunk_size))
+  with np.load(filename) as f:
+    stats = {k: f[k] for k in f.files}
+  stats['num_images'] = int(stats['num_images'])
+  return stats
+
+
+def convert_CIFAR10(ROOT, cache_dir=None):
+  """
+  Convert the pickled CIFAR-10 batches in ROOT into a uint8 on-disk store
+  that load_CIFAR10 can memory map. This only needs to run once; later calls
+  return immediately if the store already exists.
+
+  The store consists of one raw uint8 file per split holding the images in
+  (N, 32, 32, 3) layout, one .npy file per split holding the labels, and a
+  meta.json file describing the shapes. The statistics of the whole
+  training split are computed while it is written and saved to
+  stats_train_50000.npz (see ImageStats).
+
+  Inputs:
+  - ROOT: Directory holding data_batch_1, ..., data_batch_5 and test_batch.
+  - cache_dir: Directory to write the store to; defaults to ROOT/uint8_cache.
+
+  Returns:
+  - cache_dir: The directory holding the store.
+  """
+  if cache_dir is None:
+    cache_dir = os.path.join(ROOT, 'uint8_cache')
+  meta_file = os.path.join(cache_dir, 'meta.json')
+  if os.path.isfile(meta_file):
+    return cache_dir
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+
+  splits = [
+    ('train', ['data_batch_%d' % (b, ) for b in range(1,6)]),
+    ('test', ['test_batch']),
+  ]
+  meta = {'dtype': 'uint8', 'image_shape': [32, 32, 3]}
+  for split, batch_names in splits:
+    X_file = os.path.join(cache_dir, 'X_%s.u8' % split)
+    num_images = 10000 * len(batch_names)
+    X_out = np.memmap(X_file + '.tmp', dtype=np.uint8, mode='w+',
+                      shape=(num_images, 32, 32, 3))
+    ys = []
+    stats = ImageStats(channel_axis=-1)
+    for i, batch_name in enumerate(batch_names):
+      X, Y = load_CIFAR_batch(os.path.join(ROOT, batch_name), dtype=np.uint8)
+      X_out[i * 10000:(i + 1) * 10000] = X
+      ys.append(Y)
+      if split == 'train':
+        stats.update(X)
+    if split == 'train':
+      save_image_stats(os.path.join(cache_dir, 'stats_train_%d.npz'
+                                    % num_images), stats.result())
+    X_out.flush()
+    del X_out
+    os.rename(X_file + '.tmp', X_file)
+    np.save(os.path.join(cache_dir, 'y_%s.npy' % split),
+            np.concatenate(ys).astype(np.int64))
+    meta['num_%s' % split] = num_images
+
+  # meta.json is written last so that a partially written store is never
+  # picked up by load_CIFAR10.
+  with open(meta_file + '.tmp', 'w') as f:
+    json.dump(meta, f)
+  os.rename(meta_file + '.tmp', meta_file)
+  return cache_dir
+
+def load_CIFAR10(ROOT, mmap=False, cache_dir=None):
+  """
+  load all of cifar
+
+  If mmap is True, the images are returned as read-only uint8 np.memmap
+  arrays backed by the store written by convert_CIFAR10 (created on first
+  use). Nothing is read until it is indexed, and processes opening the same
+  store share its pages. Convert minibatches to float as they are consumed,
+  e.g. X[batch_mask].astype(np.float64); Solver does this automatically.
+  """
+  if mmap:
+    cache_dir = convert_CIFAR10(ROOT, cache_dir=cache_dir)
+    with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+      meta = json.load(f)
+    image_shape = tuple(meta['image_shape'])
+    arrays = []
+    for split in ('train', 'test'):
+      X = np.memmap(os.path.join(cache_dir, 'X_%s.u8' % split), mode='r',
+                    dtype=meta['dtype'],
+                    shape=(meta['num_%s' % split], ) + image_shape)
+      Y = np.load(os.path.join(cache_dir, 'y_%s.npy' % split))
+      arrays.extend([X, Y])
+    return tuple(arrays)
+
   xs = []
   ys = []
   for b in range(1,6):
@@ -45,38 +250,63 @@ def load_CIFAR10(ROOT):
 
 
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, dtype=np.float64, chunk_size=1000,
+                     report_memory=False):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The images are read from the uint8 store of load_CIFAR10(mmap=True) and
+    split with slices, so the only full-size arrays allocated are the
+    returned ones. Mean subtraction and the transpose to channels-first
+    layout are done chunk by chunk while filling them. The mean image is
+    cached in the store as stats_train_<num_training>.npz, so it is only
+    computed the first time.
+
+    Inputs:
+    - num_training, num_validation, num_test: Sizes of the splits.
+    - subtract_mean: Whether to subtract the mean training image.
+    - dtype: numpy datatype of the returned images. np.float32 halves the
+      memory footprint and is what the convolutional networks train in.
+    - chunk_size: Number of images converted at a time.
+    - report_memory: If True, print the peak memory allocated while loading.
     """
+    if report_memory:
+      import tracemalloc
+      tracemalloc.start()
+
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
-    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
+    cache_dir = convert_CIFAR10(cifar10_dir)
+    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir, mmap=True,
+                                                    cache_dir=cache_dir)
         
     # Subsample the data
-    mask = list(range(num_training, num_training + num_validation))
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = list(range(num_training))
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = list(range(num_test))
-    X_test = X_test[mask]
-    y_test = y_test[mask]
+    X_val = X_train[num_training:num_training + num_validation]
+    y_val = y_train[num_training:num_training + num_validation]
+    X_train = X_train[:num_training]
+    y_train = y_train[:num_training]
+    X_test = X_test[:num_test]
+    y_test = y_test[:num_test]
 
     # Normalize the data: subtract the mean image
+    mean_image = None
     if subtract_mean:
-      mean_image = np.mean(X_train, axis=0)
-      X_train -= mean_image
-      X_val -= mean_image
-      X_test -= mean_image
+      stats_file = os.path.join(cache_dir, 'stats_train_%d.npz' % num_training)
+      stats = load_image_stats(stats_file, X_train, channel_axis=-1,
+                               chunk_size=chunk_size)
+      mean_image = stats['mean_image']
     
     # Transpose so that channels come first
-    X_train = X_train.transpose(0, 3, 1, 2).copy()
-    X_val = X_val.transpose(0, 3, 1, 2).copy()
-    X_test = X_test.transpose(0, 3, 1, 2).copy()
+    X_train = _to_channels_first(X_train, mean_image, dtype, chunk_size)
+    X_val = _to_channels_first(X_val, mean_image, dtype, chunk_size)
+    X_test = _to_channels_first(X_test, mean_image, dtype, chunk_size)
+
+    if report_memory:
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      print('get_CIFAR10_data peak memory: %.1f MB' % (peak / 1024.0 ** 2))
 
     # Package data into a dictionary
     return {
@@ -84,9 +314,70 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
       'X_val': X_val, 'y_val': y_val,
       'X_test': X_test, 'y_test': y_test,
     }
+
+
+def _to_channels_first(X, mean_image, dtype, chunk_size):
+  """
+  Copy (N, H, W, C) images into a new (N, C, H, W) array of the given dtype,
+  subtracting mean_image (of shape (H, W, C)) unless it is None. Works one
+  chunk of images at a time so no full-size temporaries are created.
+  """
+  N, H, W, C = X.shape
+  out = np.empty((N, C, H, W), dtype=dtype)
+  if mean_image is not None:
+    mean_image = mean_image.transpose(2, 0, 1)
+  for start in range(0, N, chunk_size):
+    out_chunk = out[start:start + chunk_size]
+    out_chunk[...] = X[start:start + chunk_size].transpose(0, 3, 1, 2)
+    if mean_image is not None:
+      out_chunk -= mean_image
+  return out
     
 
-def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
+def _read_tiny_imagenet_image(img_file):
+  """ read a single 64x64 image as a (3, 64, 64) uint8 array """
+  img = imread(img_file)
+  if img.ndim == 2:
+    ## grayscale file
+    img.shape = (64, 64, 1)
+  return img.transpose(2, 0, 1)
+
+
+def _decode_images(img_files, out, num_workers=None, use_processes=False,
+                   desc='images', print_every=5000):
+  """
+  Decode a list of image files into the preallocated array out, so that
+  out[i] holds the image read from img_files[i]. Images are decoded on a
+  pool of num_workers threads (or processes if use_processes is True) and
+  copied into out as they complete.
+  """
+  if num_workers is None:
+    num_workers = os.cpu_count() or 1
+  if num_workers > 1:
+    if use_processes:
+      pool = ProcessPoolExecutor(max_workers=num_workers)
+    else:
+      pool = ThreadPoolExecutor(max_workers=num_workers)
+    chunksize = max(1, len(img_files) // (4 * num_workers))
+    imgs = pool.map(_read_tiny_imagenet_image, img_files, chunksize=chunksize)
+  else:
+    pool = None
+    imgs = map(_read_tiny_imagenet_image, img_files)
+
+  try:
+    for i, img in enumerate(imgs):
+      out[i] = img
+      if (i + 1) % print_every == 0 or i + 1 == len(img_files):
+        print('loading %s %d / %d' % (desc, i + 1, len(img_files)))
+  finally:
+    if pool is not None:
+      pool.shutdown()
+  return out
+
+
+def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True,
+                       num_workers=None, use_processes=False, cache_dir=None,
+                       mmap=False):
   """
   Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
   TinyImageNet-200 have the same directory structure, so this can be used
@@ -96,6 +387,20 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
   - path: String giving path to the directory to load.
   - dtype: numpy datatype used to load the data.
   - subtract_mean: Whether to subtract the mean training image.
+  - num_workers: Number of workers decoding images in parallel; defaults to
+    the number of CPUs. Use 1 to decode on the calling thread.
+  - use_processes: If True, decode with a process pool instead of threads.
+  - cache_dir: If not None, the decoded images are written here as packed
+    uint8 shards (X_train.u8, X_val.u8, X_test.u8) together with an
+    index.npz of labels and wnids, the training set statistics (stats.npz,
+    see ImageStats) and a meta.json file. Later calls with the same
+    cache_dir read the shards instead of decoding the images again.
+  - mmap: If True (requires cache_dir), X_train, X_val and X_test are
+    returned as read-only uint8 np.memmap arrays over the shards, so
+    reloading takes no time and no memory. They are not converted to dtype
+    and subtract_mean does not modify them; Solver converts each minibatch
+    to float and subtracts data['mean_image'] from it instead if
+    data['subtract_mean'] is True.
 
   Returns: A dictionary with the following entries:
   - class_names: A list where class_names[i] is a list of strings giving the
@@ -108,7 +413,23 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
   - y_test: (N_test,) array of test labels; if test labels are not available
     (such as in student code) then y_test will be None.
   - mean_image: (3, 64, 64) array giving mean training image
+  - subtract_mean: The subtract_mean argument, telling whether mean_image is
+    (or, for mmap arrays, is to be) subtracted from the images.
   """
+  if mmap and cache_dir is None:
+    raise ValueError('mmap=True requires a cache_dir')
+  if cache_dir is not None and os.path.isfile(os.path.join(cache_dir, 'meta.json')):
+    return _load_tiny_imagenet_cache(cache_dir, dtype, subtract_mean, mmap)
+
+  # Decode straight into the uint8 shards when building the cache
+  if cache_dir is not None and not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+  def new_images(name, num_images):
+    if cache_dir is None:
+      return np.zeros((num_images, 3, 64, 64), dtype=dtype)
+    return np.memmap(os.path.join(cache_dir, '%s.u8.tmp' % name),
+                     dtype=np.uint8, mode='w+', shape=(num_images, 3, 64, 64))
+
   # First load wnids
   with open(os.path.join(path, 'wnids.txt'), 'r') as f:
     wnids = [x.strip() for x in f]
@@ -119,37 +440,26 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
   # Use words.txt to get names for each class
   with open(os.path.join(path, 'words.txt'), 'r') as f:
     wnid_to_words = dict(line.split('\t') for line in f)
-    for wnid, words in wnid_to_words.iteritems():
+    for wnid, words in wnid_to_words.items():
       wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
   class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-  # Next load training data.
-  X_train = []
+  # Next load training data. Collect the filenames of every synset first so
+  # that all images can be decoded straight into one preallocated array.
+  train_files = []
   y_train = []
-  for i, wnid in enumerate(wnids):
-    if (i + 1) % 20 == 0:
-      print('loading training data for synset %d / %d' % (i + 1, len(wnids)))
+  for wnid in wnids:
     # To figure out the filenames we need to open the boxes file
     boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
     with open(boxes_file, 'r') as f:
       filenames = [x.split('\t')[0] for x in f]
-    num_images = len(filenames)
-    
-    X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-    y_train_block = wnid_to_label[wnid] * np.ones(num_images, dtype=np.int64)
-    for j, img_file in enumerate(filenames):
-      img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        ## grayscale file
-        img.shape = (64, 64, 1)
-      X_train_block[j] = img.transpose(2, 0, 1)
-    X_train.append(X_train_block)
-    y_train.append(y_train_block)
-      
-  # We need to concatenate all training data
-  X_train = np.concatenate(X_train, axis=0)
+    train_files.extend(os.path.join(path, 'train', wnid, 'images', img_file)
+                       for img_file in filenames)
+    y_train.append(wnid_to_label[wnid] * np.ones(len(filenames), dtype=np.int64))
   y_train = np.concatenate(y_train, axis=0)
+  X_train = new_images('X_train', len(train_files))
+  _decode_images(train_files, X_train, num_workers, use_processes,
+                 desc='training images')
   
   # Next load validation data
   with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
@@ -157,29 +467,22 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
     val_wnids = []
     for line in f:
       img_file, wnid = line.split('\t')[:2]
-      img_files.append(img_file)
+      img_files.append(os.path.join(path, 'val', 'images', img_file))
       val_wnids.append(wnid)
     num_val = len(img_files)
     y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-    X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-      img_file = os.path.join(path, 'val', 'images', img_file)
-      img = imread(img_file)
-      if img.ndim == 2:
-        img.shape = (64, 64, 1)
-      X_val[i] = img.transpose(2, 0, 1)
+    X_val = new_images('X_val', num_val)
+    _decode_images(img_files, X_val, num_workers, use_processes,
+                   desc='validation images')
 
   # Next load test images
   # Students won't have test labels, so we need to iterate over files in the
   # images directory.
   img_files = os.listdir(os.path.join(path, 'test', 'images'))
-  X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-  for i, img_file in enumerate(img_files):
-    img_file = os.path.join(path, 'test', 'images', img_file)
-    img = imread(img_file)
-    if img.ndim == 2:
-      img.shape = (64, 64, 1)
-    X_test[i] = img.transpose(2, 0, 1)
+  X_test = new_images('X_test', len(img_files))
+  _decode_images([os.path.join(path, 'test', 'images', img_file)
+                  for img_file in img_files],
+                 X_test, num_workers, use_processes, desc='test images')
 
   y_test = None
   y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
@@ -191,6 +494,11 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
         img_file_to_wnid[line[0]] = line[1]
     y_test = [wnid_to_label[img_file_to_wnid[img_file]] for img_file in img_files]
     y_test = np.array(y_test)
+
+  if cache_dir is not None:
+    _save_tiny_imagenet_cache(cache_dir, X_train, X_val, X_test, y_train,
+                              y_val, y_test, wnids, class_names)
+    return _load_tiny_imagenet_cache(cache_dir, dtype, subtract_mean, mmap)
   
   mean_image = X_train.mean(axis=0)
   if subtract_mean:
@@ -208,14 +516,249 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
     'y_test': y_test,
     'class_names': class_names,
     'mean_image': mean_image,
+    'subtract_mean': subtract_mean,
   }
 
 
+def _save_tiny_imagenet_cache(cache_dir, X_train, X_val, X_test, y_train, y_val,
+                              y_test, wnids, class_names, chunk_size=1000):
+  """
+  Finish a TinyImageNet cache whose image shards were decoded into
+  cache_dir/X_*.u8.tmp memmaps: compute the training set statistics, write
+  the label index and metadata, and move the shards into place. meta.json
+  is written last, so an interrupted conversion is never mistaken for a
+  complete one.
+  """
+  save_image_stats(os.path.join(cache_dir, 'stats.npz'),
+                   compute_image_stats(X_train, channel_axis=1,
+                                       chunk_size=chunk_size))
+
+  index = {'y_train': y_train, 'y_val': y_val, 'wnids': np.array(wnids)}
+  if y_test is not None:
+    index['y_test'] = y_test
+  np.savez(os.path.join(cache_dir, 'index.npz'), **index)
+
+  for name, X in [('X_train', X_train), ('X_val', X_val), ('X_test', X_test)]:
+    X.flush()
+    os.rename(os.path.join(cache_dir, '%s.u8.tmp' % name),
+              os.path.join(cache_dir, '%s.u8' % name))
+
+  meta = {
+    'num_train': X_train.shape[0],
+    'num_val': X_val.shape[0],
+    'num_test': X_test.shape[0],
+    'image_shape': [3, 64, 64],
+    'class_names': class_names,
+  }
+  meta_file = os.path.join(cache_dir, 'meta.json')
+  with open(meta_file + '.tmp', 'w') as f:
+    json.dump(meta, f)
+  os.rename(meta_file + '.tmp', meta_file)
+
+
+def _load_tiny_imagenet_cache(cache_dir, dtype, subtract_mean, mmap):
+  """
+  Open a TinyImageNet cache written by _save_tiny_imagenet_cache. Returns the
+  same dictionary as load_tiny_imagenet.
+  """
+  with open(os.path.join(cache_dir, 'meta.json'), 'r') as f:
+    meta = json.load(f)
+  index = np.load(os.path.join(cache_dir, 'index.npz'))
+  stats = load_image_stats(os.path.join(cache_dir, 'stats.npz'))
+  mean_image = stats['mean_image'].astype(dtype)
+
+  data = {
+    'class_names': meta['class_names'],
+    'y_train': index['y_train'],
+    'y_val': index['y_val'],
+    'y_test': index['y_test'] if 'y_test' in index.files else None,
+    'mean_image': mean_image,
+    'subtract_mean': subtract_mean,
+  }
+  for split in ('train', 'val', 'test'):
+    X = np.memmap(os.path.join(cache_dir, 'X_%s.u8' % split), mode='r',
+                  dtype=np.uint8,
+                  shape=(meta['num_%s' % split], ) + tuple(meta['image_shape']))
+    if not mmap:
+      X = X.astype(dtype)
+      if subtract_mean:
+        X -= mean_image[None]
+    data['X_%s' % split] = X
+  return data
+
+
+class ModelRegistry(object):
+  """
+  A ModelRegistry gives access to the models saved in a directory without
+  loading all of them up front.
+
+  The directory is indexed by file name, modification time and size; files
+  whose first bytes do not look like a pickle (such as README.txt) are left
+  out of the index without being read further. Models are unpickled the
+  first time they are requested and at most max_models of them are kept in
+  memory, evicting the least recently used. A model is reloaded if its file
+  changes on disk. A file that turns out not to unpickle is dropped from the
+  index, as load_models skips it. get_many loads several models at once.
+
+  Example usage:
+
+  registry = ModelRegistry('models')
+  print(registry.names())
+  model = registry['best_model.pkl']
+  """
+
+  # A pickled dictionary starts with MARK or EMPTY_DICT (protocols 0 and 1)
+  # or with PROTO followed by the protocol number (protocol 2 and up)
+  PICKLE_HEADERS = (b'(', b'}')
+
+  def __init__(self, models_dir, max_models=8, num_workers=None,
+               use_processes=False):
+    """
+    Inputs:
+    - models_dir: String giving the path to a directory containing model
+      files. Each model file is a pickled dictionary with a 'model' field.
+    - max_models: Maximum number of models kept in memory.
+    - num_workers: Number of workers used by get_many; defaults to the number
+      of CPUs.
+    - use_processes: If True, get_many unpickles on a pool of processes
+      rather than threads. Unpickling holds the GIL, so threads only overlap
+      reading the files; processes unpickle in parallel on several CPUs but
+      send each model back pickled, which pays off for models made of many
+      small objects rather than a few large arrays.
+    """
+    self.models_dir = models_dir
+    self.max_models = max_models
+    self.num_workers = num_workers or os.cpu_count() or 1
+    self.use_processes = use_processes
+    self._index = {}
+    self._cache = OrderedDict()
+    self._lock = threading.Lock()
+    self.refresh()
+
+  def _stat(self, name):
+    st = os.stat(os.path.join(self.models_dir, name))
+    return (st.st_mtime, st.st_size)
+
+  def _is_pickle(self, name):
+    with open(os.path.join(self.models_dir, name), 'rb') as f:
+      header = bytearray(f.read(2))
+    if header[:1] == b'\x80':
+      return len(header) == 2 and 2 <= header[1] <= pickle.HIGHEST_PROTOCOL
+    return bytes(header[:1]) in self.PICKLE_HEADERS
+
+  def refresh(self):
+    """
+    Rescan the directory. Only files that are new or whose modification time
+    or size changed are sniffed again.
+    """
+    index = {}
+    for name in os.listdir(self.models_dir):
+      if not os.path.isfile(os.path.join(self.models_dir, name)):
+        continue
+      key = self._stat(name)
+      if name in self._index and self._index[name] == key:
+        index[name] = key
+      elif self._is_pickle(name):
+        index[name] = key
+    self._index = index
+    with self._lock:
+      for name in list(self._cache):
+        if name not in index:
+          del self._cache[name]
+
+  def names(self):
+    """ Return the sorted names of the model files in the index. """
+    return sorted(self._index)
+
+  def __len__(self):
+    return len(self._index)
+
+  def __iter__(self):
+    return iter(self.names())
+
+  def __contains__(self, name):
+    return name in self._index
+
+  def __getitem__(self, name):
+    """
+    Return the model saved in the file name, loading it if it is not in
+    memory or its file changed since it was loaded.
+    """
+    return self._get(name)
+
+  def _is_cached(self, name):
+    key = self._stat(name)
+    with self._lock:
+      return name in self._cache and self._cache[name][0] == key
+
+  def _get(self, name, pending=None):
+    """
+    Implement __getitem__, taking the model from the future pending instead
+    of unpickling it here if it has to be loaded.
+    """
+    if name not in self._index:
+      raise KeyError(name)
+    key = self._stat(name)
+    with self._lock:
+      if name in self._cache and self._cache[name][0] == key:
+        self._cache[name] = self._cache.pop(name)
+        return self._cache[name][1]
+
+    try:
+      if pending is None:
+        model = _load_model(os.path.join(self.models_dir, name))
+      else:
+        model = pending.result()
+    except pickle.UnpicklingError:
+      # The first bytes looked like a pickle but the file is not one.
+      with self._lock:
+        self._index.pop(name, None)
+      raise
+
+    with self._lock:
+      self._index[name] = key
+      self._cache.pop(name, None)
+      self._cache[name] = (key, model)
+      while len(self._cache) > self.max_models:
+        self._cache.popitem(last=False)
+    return model
+
+  def get_many(self, names=None):
+    """
+    Return a dictionary mapping each of names (default: every indexed file)
+    to its model, loading the ones not in memory on a pool of num_workers
+    threads or processes (see use_processes).
+    """
+    if names is None:
+      names = self.names()
+    if len(names) <= 1 or self.num_workers <= 1:
+      return {name: self[name] for name in names}
+    if self.use_processes:
+      pool = ProcessPoolExecutor(max_workers=self.num_workers)
+    else:
+      pool = ThreadPoolExecutor(max_workers=self.num_workers)
+    try:
+      pending = {}
+      for name in names:
+        if name in self._index and not self._is_cached(name):
+          pending[name] = pool.submit(_load_model,
+                                      os.path.join(self.models_dir, name))
+      return {name: self._get(name, pending.get(name)) for name in names}
+    finally:
+      pool.shutdown()
+
+
+def _load_model(path):
+  """ unpickle the model saved in the file path """
+  with open(path, 'rb') as f:
+    return load_pickle(f)['model']
+
+
 def load_models(models_dir):
   """
   Load saved models from disk. This will attempt to unpickle all files in a
   directory; any files that give errors on unpickling (such as README.txt) will
-  be skipped.
+  be skipped. Use a ModelRegistry instead to load only the models you need.
 
   Inputs:
   - models_dir: String giving the path to a directory containing model files.
@@ -224,11 +767,11 @@ def load_models(models_dir):
   Returns:
   A dictionary mapping model file names to models.
   """
+  registry = ModelRegistry(models_dir, max_models=0)
   models = {}
-  for model_file in os.listdir(models_dir):
-    with open(os.path.join(models_dir, model_file), 'rb') as f:
-      try:
-        models[model_file] = load_pickle(f)['model']
-      except pickle.UnpicklingError:
-        continue
+  for model_file in registry.names():
+    try:
+      models[model_file] = registry[model_file]
+    except pickle.UnpicklingError:
+      continue
   return models
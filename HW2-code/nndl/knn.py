@@ -1,41 +1,260 @@
+import multiprocessing
+
 import numpy as np
 import pdb
+from scipy.spatial import cKDTree
 
 """
 This code was based off of code from cs231n at Stanford University, and modified for ECE C147/C247 at UCLA.
 """
 
+# Above this many dimensions a kd-tree visits nearly every leaf on each query
+# and is slower than brute force, so train() does not build one.
+KD_TREE_MAX_DIM = 12
+
+# The distances that compute_distances(), query() and predict() can compute
+# by name; see KNN._distance_tile().
+METRICS = ('l2', 'l1', 'linf', 'cosine', 'chi2')
+
 class KNN(object):
 
   def __init__(self):
     pass
 
-  def train(self, X, y):
+  def train(self, X, y, index=None, leaf_size=16, num_bits=256, seed=None,
+            dtype=None, table_bits=None):
     """
 	Inputs:
 	- X is a numpy array of size (num_examples, D)
 	- y is a numpy array of size (num_examples, )
+    - index: If 'kdtree', build a kd-tree over X that query() and predict()
+      use to find exact nearest neighbors without comparing against every
+      training point. The tree is only built when D <= KD_TREE_MAX_DIM.
+      If 'lsh', build an LSHIndex over X that query() and predict() use to
+      find approximate nearest neighbors. Otherwise queries use brute force.
+    - leaf_size: Number of points in a leaf of the kd-tree.
+    - num_bits: Length of the LSH codes.
+    - seed: Seed for the random projections of the LSH index.
+    - table_bits: If not None, the LSH index looks up candidates in hash
+      tables with keys of this many bits instead of ranking every training
+      point, e.g. 16 for near-duplicate search; see LSHIndex.
+    - dtype: If not None, keep a copy of X of this datatype for the matrix
+      products of the L2 distance computations, e.g. np.float32 to halve
+      their memory traffic and roughly double their speed. Distances then
+      carry float32 round-off, which can reorder near ties. Integer data
+      (e.g. raw uint8 pixels) defaults to a float64 copy.
+
+    Training points can later be added and removed with add() and remove().
+    """
+    if index not in (None, 'kdtree', 'lsh'):
+      raise ValueError('Unknown index "%s"' % index)
+    if dtype is None and np.issubdtype(X.dtype, np.integer):
+      dtype = np.float64
+    if index == 'kdtree' and X.shape[1] > KD_TREE_MAX_DIM:
+      index = None
+    self.index = index
+    self.dtype = dtype
+    self.leaf_size = leaf_size
+    self.tree = None
+    self.lsh = None
+
+    # X_train, y_train and the arrays derived from them are views of the
+    # first num_train rows of backing stores, which add() grows by doubling.
+    # The stores start out as X and y themselves, which are copied before
+    # they are first modified. The squared norms of the training points and
+    # the copy of X in dtype are reused by every L2 distance computation.
+    self._stores = {'X_train': X, 'y_train': y, 'sq_norms': _sq_norms(X)}
+    if dtype is not None:
+      self._stores['X_dot'] = X.astype(dtype)
+    if index == 'lsh':
+      self.lsh = LSHIndex(X, num_bits=num_bits, seed=seed,
+                          table_bits=table_bits)
+      self._stores['codes'] = self.lsh.codes
+    self._capacity = X.shape[0]
+    self._owns_stores = False
+    self._set_size(X.shape[0])
+    if index is not None:
+      self._build_index()
+
+
+  def add(self, X, y):
+    """
+    Add training points to the classifier, updating the cached norms and any
+    index incrementally. The backing stores double in capacity when they are
+    full, so adding points takes amortized time proportional to their number.
+
+    The new points get the indices num_train, ..., num_train + len(X) - 1.
+    An LSH index encodes them with its existing projections. A kd-tree or
+    the hash tables of an LSH index keep covering the points they were built
+    on and the added points are searched by brute force; see _update_index().
+
+    Inputs:
+    - X: A numpy array of shape (num_new, D) of new training points.
+    - y: A numpy array of shape (num_new,) of their labels.
+    """
+    start = self.X_train.shape[0]
+    end = start + X.shape[0]
+    self._reserve(end)
+    new = {'X_train': X, 'y_train': y, 'sq_norms': _sq_norms(X)}
+    if 'X_dot' in self._stores:
+      new['X_dot'] = X.astype(self.dtype)
+    if self.lsh is not None:
+      new['codes'] = self.lsh.encode(X)
+    for name, a in new.items():
+      self._stores[name][start:end] = a
+    self._set_size(end)
+    if self.index is not None:
+      self._extra = np.concatenate((self._extra, np.arange(start, end)))
+      self._update_index()
+
+
+  def remove(self, idx):
+    """
+    Remove training points from the classifier. To avoid shifting the whole
+    training set, the last remaining points are moved into the rows of the
+    removed ones, so the indices of up to len(idx) other points change; they
+    are returned so that callers can update references to them. A kd-tree
+    or the hash tables of an LSH index keep the removed points, which
+    queries skip; see _update_index().
+
+    Inputs:
+    - idx: Indices of the training points to remove. Negative indices count
+      from the end, as in numpy; an IndexError is raised for indices outside
+      [-num_train, num_train).
+
+    Returns:
+    - moved_from: Old indices of the points that were moved.
+    - moved_to: Their new indices.
+    """
+    num_train = self.X_train.shape[0]
+    idx = np.asarray(idx, dtype=np.int64).ravel()
+    out_of_range = (idx < -num_train) | (idx >= num_train)
+    if np.any(out_of_range):
+      raise IndexError('index %d is out of bounds for %d training points'
+                       % (idx[out_of_range][0], num_train))
+    if idx.shape[0] == 0:
+      return idx, idx
+    idx = np.unique(idx % num_train)
+    size = num_train - idx.shape[0]
+    self._reserve(num_train)
+    moved_to = idx[idx < size]
+    moved_from = np.setdiff1d(np.arange(size, num_train), idx)
+    for store in self._stores.values():
+      store[moved_to] = store[moved_from]
+    self._set_size(size)
+    if self.index is not None:
+      # Map the old row of each point to its new one, or -1 if it was removed.
+      new_rows = np.arange(num_train)
+      new_rows[idx] = -1
+      new_rows[moved_from] = moved_to
+      indexed = self._index_rows >= 0
+      self._index_rows[indexed] = new_rows[self._index_rows[indexed]]
+      extra = new_rows[self._extra]
+      self._extra = np.sort(extra[extra >= 0])
+      self._update_index()
+    return moved_from, moved_to
+
+
+  def _build_index(self):
     """
-    self.X_train = X
-    self.y_train = y
+    Build the kd-tree or the hash tables of the LSH index over the current
+    training points.
+    """
+    if self.index == 'kdtree':
+      # The tree gets its own copy of the points, as remove() moves rows of
+      # X_train in place.
+      self.tree = cKDTree(self.X_train, leafsize=self.leaf_size,
+                          copy_data=True)
+    else:
+      self.lsh.build_tables()
+    # The row of X_train holding each point of the index, or -1 if it has
+    # been removed since, and the rows of the points added since the index
+    # was built, which query() searches by brute force.
+    self._index_rows = np.arange(self.X_train.shape[0])
+    self._extra = np.empty(0, dtype=np.int64)
+
+
+  def _update_index(self):
+    """
+    Rebuild the kd-tree or LSH hash tables after add() or remove() once the
+    removed points they still hold and the added points they do not cover
+    together outnumber a quarter of them. Until then queries skip the former
+    and search the latter by brute force, so rebuilding takes amortized
+    constant time per point.
+    """
+    stale = np.count_nonzero(self._index_rows < 0) + self._extra.shape[0]
+    if 4*stale > self._index_rows.shape[0]:
+      self._build_index()
+
+
+  def _reserve(self, size):
+    """
+    Make sure the backing stores are owned by the classifier and can hold
+    size training points, reallocating them with at least twice the
+    capacity if they are full.
+    """
+    if self._owns_stores and size <= self._capacity:
+      return
+    num_train = self.X_train.shape[0]
+    if size > self._capacity:
+      self._capacity = max(size, 2*self._capacity)
+    for name, store in self._stores.items():
+      grown = np.empty((self._capacity,) + store.shape[1:], dtype=store.dtype)
+      grown[:num_train] = store[:num_train]
+      self._stores[name] = grown
+    self._owns_stores = True
+
+
+  def _set_size(self, num_train):
+    """
+    Point X_train, y_train and the arrays derived from them at the first
+    num_train rows of the backing stores.
+    """
+    for name, store in self._stores.items():
+      if name == 'codes':
+        self.lsh.codes = store[:num_train]
+      else:
+        setattr(self, name, store[:num_train])
+    if 'X_dot' not in self._stores:
+      self.X_dot = self.X_train
+    # The shared-memory copy of the training data made by _query_parallel()
+    # is out of date.
+    self._shared = None
 
-  def compute_distances(self, X, norm=None):
+  def compute_distances(self, X, norm=None, memory_budget=2**27):
     """
     Compute the distance between each test point in X and each training point
     in self.X_train.
 
     Inputs:
     - X: A numpy array of shape (num_test, D) containing test data.
-	- norm: the function with which the norm is taken.
+	- norm: the function with which the norm is taken, or the name of one of
+      METRICS, which are computed without loops a tile at a time. Defaults to
+      'l2'. A function is called on every pair of points and is slow.
+    - memory_budget: Approximate number of bytes of working memory to use
+      for the tiles of a named metric.
 
     Returns:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
-      is the Euclidean distance between the ith test point and the jth training
+      is the distance between the ith test point and the jth training
       point.
     """
     if norm is None:
-      norm = lambda x: np.sqrt(np.sum(x**2))
-      #norm = 2
+      norm = 'l2'
+    if not callable(norm):
+      _check_metric(norm)
+      if norm == 'l2':
+        return self.compute_L2_distances_vectorized(X)
+      num_test = X.shape[0]
+      num_train = self.X_train.shape[0]
+      test_tile, train_tile = _tile_shape(num_test, num_train, 1, memory_budget,
+                                          _tile_bytes(norm))
+      dists = np.empty((num_test, num_train))
+      for i in range(0, num_test, test_tile):
+        for j in range(0, num_train, train_tile):
+          dists[i:i + test_tile, j:j + train_tile] = self._distance_tile(
+              norm, X[i:i + test_tile], slice(j, j + train_tile))
+      return dists
 
     num_test = X.shape[0]
     num_train = self.X_train.shape[0]
@@ -57,13 +276,15 @@ class KNN(object):
 
     return dists
 
-  def compute_L2_distances_vectorized(self, X):
+  def compute_L2_distances_vectorized(self, X, squared=False):
     """
     Compute the distance between each test point in X and each training point
     in self.X_train WITHOUT using any for loops.
 
     Inputs:
     - X: A numpy array of shape (num_test, D) containing test data.
+    - squared: If True, return squared distances, which rank the training
+      points the same way (e.g. for predict_labels) and skip the sqrt.
 
     Returns:
     - dists: A numpy array of shape (num_test, num_train) where dists[i, j]
@@ -87,9 +308,11 @@ class KNN(object):
 	# ================================================================ #
     
     
-    sum_test = np.sum(X**2,axis=1)
-    sum_train = np.sum(self.X_train**2,axis=1)
-    dists = np.sqrt(sum_test.reshape(-1,1) + sum_train - 2*X.dot(self.X_train.T))
+    dists = self._sq_dists(X, self.X_dot, self.sq_norms)
+    # Round-off can make the squared distance of (near) duplicates negative.
+    np.maximum(dists, 0, out=dists)
+    if not squared:
+      np.sqrt(dists, out=dists)
     
 
 	# ================================================================ #
@@ -114,27 +337,779 @@ class KNN(object):
     """
     num_test = dists.shape[0]
     y_pred = np.zeros(num_test)
-    for i in np.arange(num_test):
-      # A list of length k storing the labels of the k nearest neighbors to
-      # the ith test point.
-      closest_y = []
-  	  # ================================================================ #
-  	  # YOUR CODE HERE:
-  	  #   Use the distances to calculate and then store the labels of 
-	  #   the k-nearest neighbors to the ith test point.  The function
-	  #   numpy.argsort may be useful.
-	  #   
-	  #   After doing this, find the most common label of the k-nearest
-	  #   neighbors.  Store the predicted label of the ith training example
-	  #   as y_pred[i].  Break ties by choosing the smaller label.
-  	  # ================================================================ #
-        
-      idx = np.argsort(dists[i,:])
-      closest_y = list(self.y_train[idx[:k]])
-      y_pred[i] = max(set(closest_y), key = closest_y.count)
+    # ================================================================ #
+    # YOUR CODE HERE:
+    #   Use the distances to calculate and then store the labels of
+    #   the k-nearest neighbors to the ith test point.  The function
+    #   numpy.argsort may be useful.
+    #
+    #   After doing this, find the most common label of the k-nearest
+    #   neighbors.  Store the predicted label of the ith training example
+    #   as y_pred[i].  Break ties by choosing the smaller label.
+    # ================================================================ #
+
+    # argpartition finds the k nearest neighbors of all rows at once
+    # without sorting the rest of each row.
+    k = min(k, dists.shape[1])
+    idx = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    closest_y = self.y_train[idx]
+    y_pred[:] = _majority_vote(closest_y)
 
-  	  # ================================================================ #
-  	  # END YOUR CODE HERE
-  	  # ================================================================ #
+    # ================================================================ #
+    # END YOUR CODE HERE
+    # ================================================================ #
 
     return y_pred
+
+
+  def query(self, X, k=1, memory_budget=2**27, num_candidates=None,
+            metric='l2', num_workers=1, chunk_size=None):
+    """
+    Find the k nearest training points of each test point in X under the
+    distance metric. If train() built a kd-tree, it is used to find them
+    exactly for the 'l2', 'l1' and 'linf' metrics; if it built an LSH index,
+    they are found approximately among up to num_candidates candidates,
+    which is only supported for 'l2'. Otherwise test and training points are
+    processed in tiles and a running top-k is kept for each test point, so
+    the full (num_test, num_train) distance matrix is never formed.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors to find.
+    - memory_budget: Approximate number of bytes of working memory to use
+      for the distance tiles (128 MB by default).
+    - num_candidates: Number of candidates per test point that the LSH index
+      hands on for exact ranking; more candidates trade speed for recall.
+      Defaults to max(10 * k, 100).
+    - metric: The name of one of METRICS.
+    - num_workers: If greater than 1, split the test points into chunks and
+      query them on a pool of this many processes. The training data is
+      copied into shared memory that all workers read, rather than being
+      pickled to each of them; the copy is reused by later calls until
+      points are added or removed. memory_budget applies to each worker.
+    - chunk_size: Number of test points per task when num_workers > 1;
+      defaults to splitting the test points into 4 * num_workers chunks.
+
+    Returns:
+    - dists: A numpy array of shape (num_test, k) where dists[i, j] is the
+      distance between the ith test point and its jth nearest training point.
+    - neighbors: A numpy array of shape (num_test, k) of indices into
+      self.X_train of the nearest training points, sorted by increasing
+      distance.
+    """
+    _check_metric(metric)
+    num_test = X.shape[0]
+    k = min(k, self.X_train.shape[0])
+    if num_workers > 1:
+      return self._query_parallel(X, num_workers, chunk_size, k=k,
+                                  memory_budget=memory_budget,
+                                  num_candidates=num_candidates, metric=metric)
+    if self.tree is not None and metric in ('l2', 'l1', 'linf'):
+      p = {'l2': 2, 'l1': 1, 'linf': np.inf}[metric]
+      dists, neighbors = self._query_tree(X, k, p)
+      if self._extra.shape[0] > 0:
+        # Points added since the tree was built are searched by brute force.
+        added_d, added_i = self._query_brute(X, k, memory_budget, metric,
+                                             rows=self._extra)
+        dists, neighbors = _merge_topk(dists, neighbors, added_d, added_i, k)
+      return _sort_topk(dists, neighbors)
+    if self.lsh is not None:
+      if metric != 'l2':
+        raise ValueError('The LSH index only supports the l2 metric')
+      if num_candidates is None:
+        num_candidates = max(10*k, 100)
+      candidates = self.lsh.candidates(
+          X, num_candidates, memory_budget, min_candidates=k,
+          rows=self._index_rows, extra=self._extra)
+      return self._query_candidates(X, candidates, k, memory_budget)
+    return self._query_brute(X, k, memory_budget, metric)
+
+
+  def _sq_dists(self, X, X_train, sum_train):
+    """
+    Return the squared L2 distances, of shape (num_test, num_train), between
+    the rows of X and X_train, given the squared norms sum_train of the rows
+    of X_train. The product is computed in the datatype of self.X_dot.
+    """
+    X_dot = X.astype(self.X_dot.dtype, copy=False)
+    dists = X_dot.dot(X_train.T).astype(np.float64, copy=False)
+    dists *= -2
+    dists += _sq_norms(X).reshape(-1, 1)
+    dists += sum_train
+    return dists
+
+
+  def _query_tree(self, X, k, p):
+    """
+    Return the unsorted top-k of each test point in X among the points of
+    the kd-tree that have not been removed, as distances under the p-norm
+    and indices into X_train, each of shape (num_test, <= k).
+    """
+    num_test = X.shape[0]
+    num_live = np.count_nonzero(self._index_rows >= 0)
+    tree_k = min(k, num_live)
+    dists = np.empty((num_test, tree_k))
+    neighbors = np.empty((num_test, tree_k), dtype=np.int64)
+    if tree_k == 0:
+      return dists, neighbors
+    # Ask for one extra live neighbor: where it is as far as the kth, the
+    # tree may have left out tied points of smaller index, which brute force
+    # would keep, so those rows are resolved by _tree_ties(). Removed points
+    # are skipped, and the rows that did not get enough live neighbors are
+    # queried again for twice as many.
+    num_dead = self.tree.n - num_live
+    m = tree_k + 1 + -(-(tree_k + 1)*num_dead // num_live)
+    pending = np.arange(num_test)
+    while pending.shape[0] > 0:
+      m = min(m, self.tree.n)
+      d, idx = self.tree.query(X[pending], k=m, p=p)
+      d = d.reshape(pending.shape[0], m)
+      rows = self._index_rows[idx.reshape(pending.shape[0], m)]
+      live = rows >= 0
+      num_found = np.count_nonzero(live, axis=1)
+      done = (num_found > tree_k) | (m == self.tree.n)
+      # Move the live neighbors to the front, keeping them in order.
+      order = np.argsort(~live[done], axis=1, kind='stable')[:, :tree_k + 1]
+      d = np.take_along_axis(d[done], order, axis=1)
+      rows = np.take_along_axis(rows[done], order, axis=1)
+      tied = np.zeros(d.shape[0], dtype=bool)
+      if d.shape[1] > tree_k:
+        tied = (num_found[done] > tree_k) & (d[:, tree_k] == d[:, tree_k - 1])
+      dists[pending[done]] = d[:, :tree_k]
+      neighbors[pending[done]] = rows[:, :tree_k]
+      for r in pending[done][tied]:
+        dists[r], neighbors[r] = self._tree_ties(X[r], dists[r, -1], tree_k, p)
+      pending = pending[~done]
+      m *= 2
+    return dists, neighbors
+
+
+  def _tree_ties(self, x, radius, k, p):
+    """
+    Return the k nearest neighbors of the test point x among the live points
+    of the kd-tree, given that the kth of them is at distance radius and
+    tied with at least one more point: the tree is queried for more
+    neighbors until all points within radius are found, and the ties are
+    broken by the smaller index, as in _merge_topk().
+    """
+    m = k
+    while True:
+      m = min(2*m, self.tree.n)
+      d, idx = self.tree.query(x, k=m, p=p)
+      if d[-1] > radius or m == self.tree.n:
+        break
+    rows = self._index_rows[idx]
+    keep = (d <= radius) & (rows >= 0)
+    d, rows = d[keep], rows[keep]
+    order = np.lexsort((rows, d))[:k]
+    return d[order], rows[order]
+
+
+  def _query_parallel(self, X, num_workers, chunk_size, **kwargs):
+    """
+    Run query(X, **kwargs) on chunks of X on a pool of num_workers processes
+    that share the training data; see query().
+    """
+    num_test = X.shape[0]
+    k = kwargs['k']
+    # Copy the training arrays into shared memory once and reuse the copy
+    # until the training set changes. The workers wrap them in arrays
+    # without copying; only the test chunks and the top-k of each chunk
+    # travel through pipes.
+    if self._shared is None:
+      self._shared = {}
+      for name in ('X_train', 'X_dot', 'sq_norms'):
+        a = getattr(self, name)
+        if name == 'X_dot' and a is self.X_train:
+          continue
+        shared = multiprocessing.RawArray('b', max(a.nbytes, 1))
+        np.frombuffer(shared, dtype=a.dtype, count=a.size).reshape(a.shape)[...] = a
+        self._shared[name] = (shared, a.dtype.str, a.shape)
+    arrays = self._shared
+
+    if chunk_size is None:
+      chunk_size = max(1, (num_test - 1) // (4 * num_workers) + 1)
+    chunks = ((start, X[start:start + chunk_size], kwargs)
+              for start in range(0, num_test, chunk_size))
+    dists = np.empty((num_test, k))
+    neighbors = np.empty((num_test, k), dtype=np.int64)
+    index = {'tree': self.tree, 'lsh': self.lsh}
+    if self.index is not None:
+      index.update(_index_rows=self._index_rows, _extra=self._extra)
+    pool = multiprocessing.Pool(num_workers, initializer=_init_knn_worker,
+                                initargs=(arrays, index))
+    try:
+      for start, d, idx in pool.imap_unordered(_query_chunk, chunks):
+        dists[start:start + d.shape[0]] = d
+        neighbors[start:start + d.shape[0]] = idx
+    finally:
+      pool.close()
+      pool.join()
+    return dists, neighbors
+
+
+  def _query_brute(self, X, k, memory_budget, metric='l2', rows=None):
+    """
+    Exact tiled top-k search over the training points with the indices rows
+    (by default all of them); see query().
+    """
+    num_test = X.shape[0]
+    num_train = self.X_train.shape[0] if rows is None else rows.shape[0]
+    k = min(k, num_train)
+    test_tile, train_tile = _tile_shape(num_test, num_train, k,
+                                        memory_budget, _tile_bytes(metric))
+
+    dists = np.empty((num_test, k))
+    neighbors = np.empty((num_test, k), dtype=np.int64)
+    for i in range(0, num_test, test_tile):
+      X_tile = X[i:i + test_tile]
+      best_d = np.empty((X_tile.shape[0], 0))
+      best_i = np.empty((X_tile.shape[0], 0), dtype=np.int64)
+      for j in range(0, num_train, train_tile):
+        if rows is None:
+          train_rows = slice(j, j + train_tile)
+          idx = np.arange(j, min(j + train_tile, num_train))
+        else:
+          train_rows = idx = rows[j:j + train_tile]
+        # The l2 tiles hold squared distances, which rank the same way.
+        if metric == 'l2':
+          d = self._sq_dists(X_tile, self.X_dot[train_rows],
+                             self.sq_norms[train_rows])
+        else:
+          d = self._distance_tile(metric, X_tile, train_rows)
+        best_d, best_i = _merge_topk(best_d, best_i, d, idx, k)
+      d, idx = _sort_topk(best_d, best_i)
+      if metric == 'l2':
+        d = np.sqrt(np.maximum(d, 0))
+      dists[i:i + test_tile] = d
+      neighbors[i:i + test_tile] = idx
+
+    return dists, neighbors
+
+
+  def _distance_tile(self, metric, X, train_slice):
+    """
+    Return the distances, of shape (num_test, m), under the named metric
+    between the rows of X and the m training points selected by train_slice,
+    a slice or an array of indices:
+
+    - 'l2': sqrt(sum((x - t)**2))
+    - 'l1': sum(abs(x - t))
+    - 'linf': max(abs(x - t))
+    - 'cosine': 1 - x.dot(t) / (|x| |t|), taken as 1 if x or t is zero
+    - 'chi2': sum((x - t)**2 / (x + t)) / 2 over the entries where x + t is
+      not zero, for nonnegative data such as histograms.
+
+    'l2' and 'cosine' are computed with a matrix product. The others are
+    accumulated one dimension at a time in arrays of shape (num_test, m),
+    which is several times faster than broadcasting to (num_test, m, D).
+    """
+    if metric == 'l2':
+      d = self._sq_dists(X, self.X_dot[train_slice], self.sq_norms[train_slice])
+      return np.sqrt(np.maximum(d, 0, out=d), out=d)
+    X_train = self.X_train[train_slice]
+    if metric == 'cosine':
+      norms = (np.sqrt(_sq_norms(X)).reshape(-1, 1)
+               * np.sqrt(self.sq_norms[train_slice]))
+      norms[norms == 0] = np.inf
+      # Cast like the other metrics, so integer data cannot overflow.
+      X_train = X_train.astype(np.float64, copy=False)
+      return 1 - X.astype(np.float64, copy=False).dot(X_train.T)/norms
+    X_cols = np.ascontiguousarray(X.T, dtype=np.float64)
+    X_train_cols = np.ascontiguousarray(X_train.T, dtype=np.float64)
+    dists = np.zeros((X.shape[0], X_train.shape[0]))
+    diff = np.empty_like(dists)
+    if metric == 'chi2':
+      total = np.empty_like(dists)
+    for x, t in zip(X_cols, X_train_cols):
+      x = x.reshape(-1, 1)
+      np.subtract(x, t, out=diff)
+      if metric == 'l1':
+        np.abs(diff, out=diff)
+        dists += diff
+      elif metric == 'linf':
+        np.abs(diff, out=diff)
+        np.maximum(dists, diff, out=dists)
+      else:
+        np.add(x, t, out=total)
+        diff *= diff
+        np.divide(diff, total, out=diff, where=total != 0)
+        diff[total == 0] = 0
+        dists += diff
+    if metric == 'chi2':
+      dists *= 0.5
+    return dists
+
+
+  def _query_candidates(self, X, candidates, k, memory_budget):
+    """
+    Exact top-k search restricted to the training points candidates[i] for
+    the ith test point, which may be padded with -1 as long as each row has
+    at least k candidates; see query().
+    """
+    num_test, num_candidates = candidates.shape
+    k = min(k, num_candidates)
+    item_size = self.X_dot.dtype.itemsize
+    rows = max(memory_budget // (item_size*num_candidates*X.shape[1]), 1)
+
+    dists = np.empty((num_test, k))
+    neighbors = np.empty((num_test, k), dtype=np.int64)
+    for i in range(0, num_test, rows):
+      X_tile = X[i:i + rows]
+      idx = candidates[i:i + rows]
+      X_dot = X_tile.astype(self.X_dot.dtype, copy=False)
+      d = np.matmul(self.X_dot[idx], X_dot[:, :, np.newaxis])[:, :, 0]
+      d = (_sq_norms(X_tile).reshape(-1, 1) + self.sq_norms[idx]
+           - 2*d.astype(np.float64, copy=False))
+      d[idx < 0] = np.inf
+      d, idx = _sort_topk(*_merge_topk(d[:, :0], idx[:, :0], d, idx, k))
+      dists[i:i + rows] = np.sqrt(np.maximum(d, 0))
+      neighbors[i:i + rows] = idx
+
+    return dists, neighbors
+
+
+  def predict(self, X, k=1, memory_budget=2**27, num_candidates=None,
+              metric='l2', num_workers=1, chunk_size=None):
+    """
+    Predict a label for each test point in X from its k nearest training
+    points, found with query() in bounded memory.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) containing test data.
+    - k: The number of nearest neighbors that vote on each label.
+    - memory_budget: Approximate number of bytes of working memory to use.
+    - num_candidates: Number of LSH candidates per test point; see query().
+    - metric: The name of one of METRICS.
+    - num_workers, chunk_size: Query the test points on a pool of
+      num_workers processes; see query(). The predictions are the same as
+      with a single process.
+
+    Returns:
+    - y_pred: A numpy array of shape (num_test,) containing predicted labels.
+      Ties are broken by choosing the smaller label.
+    - neighbors: A numpy array of shape (num_test, k) of indices into
+      self.X_train of the nearest training points, nearest first.
+    """
+    _, neighbors = self.query(X, k=k, memory_budget=memory_budget,
+                              num_candidates=num_candidates, metric=metric,
+                              num_workers=num_workers, chunk_size=chunk_size)
+    return _majority_vote(self.y_train[neighbors]), neighbors
+
+
+  def recall(self, X, k=1, memory_budget=2**27, num_candidates=None):
+    """
+    Measure how well query() recovers the exact k nearest neighbors of the
+    test points X, e.g. to tune num_candidates, num_bits and table_bits of an
+    LSH index.
+
+    Returns:
+    - recall: The fraction of the exact k nearest neighbors of the test
+      points that query() returns.
+    """
+    _, found = self.query(X, k=k, memory_budget=memory_budget,
+                          num_candidates=num_candidates)
+    _, exact = self._query_brute(X, min(k, self.X_train.shape[0]),
+                                 memory_budget)
+    hits = (found[:, :, np.newaxis] == exact[:, np.newaxis, :]).any(axis=1)
+    return hits.mean()
+
+
+  def cross_validate(self, ks, num_folds=5, memory_budget=2**27, metric='l2'):
+    """
+    Estimate the accuracy of k-nearest neighbor classification for every k
+    in ks by num_folds-fold cross-validation over the training data.
+
+    The training data is split into num_folds contiguous folds. Each fold is
+    classified by the other folds: its distances are computed and its
+    max(ks) nearest neighbors sorted once, and every k then votes with the
+    first k of them, so each fold costs one distance computation regardless
+    of the number of ks.
+
+    Inputs:
+    - ks: A list of the numbers of nearest neighbors to evaluate.
+    - num_folds: The number of folds.
+    - memory_budget: Approximate number of bytes of working memory to use.
+    - metric: The name of one of METRICS.
+
+    Returns:
+    - accuracies: A numpy array of shape (len(ks), num_folds) where
+      accuracies[i, j] is the accuracy on fold j with k = ks[i].
+    """
+    folds = np.array_split(np.arange(self.X_train.shape[0]), num_folds)
+    accuracies = np.zeros((len(ks), num_folds))
+    for j, fold in enumerate(folds):
+      rest = np.concatenate(folds[:j] + folds[j + 1:])
+      knn = KNN()
+      knn.train(self.X_train[rest], self.y_train[rest], dtype=self.dtype)
+      _, neighbors = knn.query(self.X_train[fold], k=max(ks),
+                               memory_budget=memory_budget, metric=metric)
+      closest_y = knn.y_train[neighbors]
+      for i, k in enumerate(ks):
+        y_pred = _majority_vote(closest_y[:, :k])
+        accuracies[i, j] = np.mean(y_pred == self.y_train[fold])
+    return accuracies
+
+
+# The signs, +1 or -1, of the eight bits of each byte value as packed by
+# np.packbits, of shape (8, 256); see LSHIndex._lut().
+_BYTE_SIGNS = 2*np.unpackbits(np.arange(256, dtype=np.uint8).reshape(-1, 1),
+                              axis=1).T.astype(np.float32) - 1
+
+
+class LSHIndex(object):
+  """
+  Random-projection locality sensitive hashing for approximate nearest
+  neighbor search. Each point is centered on the mean of the training data
+  and projected onto num_bits random Gaussian directions; the signs of the
+  projections, packed eight to a byte, form its code. The fraction of bits on
+  which two codes differ estimates the angle between the centered points.
+
+  The candidates of a query are ranked by the asymmetric score q.dot(s) of
+  its centered projections q and the signs s of their code, which orders
+  them more accurately than the Hamming distance between codes. By default
+  every training point is ranked. With table_bits, the codes are also cut
+  into num_bits // table_bits keys, each of which files the training points
+  into the buckets of a hash table, and only the points that share a bucket
+  with the query in at least one table are ranked. That looks at a small
+  part of the training set and finds the near neighbors when they are much
+  closer than the rest, as for near duplicates; otherwise they rarely share
+  a bucket and recall drops, which recall() measures.
+
+  The codes of the training set take num_bits / 8 bytes per point, e.g. 32
+  bytes for 256 bits instead of 24 KB for a float64 CIFAR-10 image. Each
+  table adds a key and an index per point, 6 bytes for 16-bit keys.
+  """
+
+  def __init__(self, X, num_bits=256, seed=None, table_bits=None):
+    """
+    Inputs:
+    - X: A numpy array of shape (num_train, D) of training data.
+    - num_bits: Length of the codes; longer codes rank candidates more
+      accurately but take longer to compare.
+    - seed: Seed for the random projections.
+    - table_bits: If not None, the length of the hash table keys, a
+      multiple of 8 up to 32. Longer keys give smaller buckets and so fewer
+      candidates, but fewer tables and less chance for a near neighbor to
+      share a bucket with the query.
+    """
+    if table_bits is not None and (table_bits % 8 != 0 or
+                                   not 0 < table_bits <= min(num_bits, 32)):
+      raise ValueError('table_bits must be a multiple of 8 from 8 to '
+                       'min(num_bits, 32), not %s' % table_bits)
+    rng = np.random.RandomState(seed)
+    self.num_bits = num_bits
+    self.table_bits = table_bits
+    self.mean = np.mean(X, axis=0)
+    self.projections = rng.randn(X.shape[1], num_bits).astype(np.float32)
+    self.codes = self.encode(X)
+    self.tables = None
+
+
+  def encode(self, X, chunk_size=1024):
+    """
+    Return the codes of the rows of X as a uint8 array of shape
+    (N, ceil(num_bits / 8)).
+    """
+    codes = np.empty((X.shape[0], (self.num_bits + 7) // 8), dtype=np.uint8)
+    for i in range(0, X.shape[0], chunk_size):
+      codes[i:i + chunk_size] = np.packbits(
+          self._project(X[i:i + chunk_size]) > 0, axis=1)
+    return codes
+
+
+  def _project(self, X):
+    """
+    Return the projections, of shape (N, num_bits), of the rows of X
+    centered on the mean of the training data.
+    """
+    return (X - self.mean).astype(np.float32).dot(self.projections)
+
+
+  def _signs(self, codes):
+    """
+    Unpack codes into float32 arrays of +1 and -1, one entry per bit.
+    """
+    bits = np.unpackbits(codes, axis=1)[:, :self.num_bits]
+    return 2*bits.astype(np.float32) - 1
+
+
+  def _keys(self, codes):
+    """
+    Return the hash table keys of codes, of shape (num_tables, N): the key
+    of table t is made of bits t * table_bits to (t + 1) * table_bits - 1.
+    """
+    key_bytes = self.table_bits // 8
+    num_tables = self.num_bits // self.table_bits
+    key_dtype = np.min_scalar_type(2**self.table_bits - 1)
+    codes = codes[:, :num_tables*key_bytes].reshape(-1, num_tables, key_bytes)
+    keys = np.zeros((num_tables, codes.shape[0]), dtype=key_dtype)
+    for b in range(key_bytes):
+      keys <<= 8
+      keys |= codes[:, :, b].T
+    return keys
+
+
+  def _lut(self, proj):
+    """
+    Return lookup tables, of shape (N, num_bytes, 256), of the asymmetric
+    score of the rows of proj: the score of a row against a code is the sum
+    over its bytes j of lut[row, j, codes[j]].
+    """
+    num_bytes = (self.num_bits + 7) // 8
+    padded = np.zeros((proj.shape[0], num_bytes*8), dtype=np.float32)
+    padded[:, :self.num_bits] = proj
+    lut = padded.reshape(-1, 8).dot(_BYTE_SIGNS)
+    return lut.reshape(proj.shape[0], num_bytes, 256)
+
+
+  def build_tables(self):
+    """
+    File the points of self.codes into the buckets of the hash tables. Each
+    table holds the keys of the points in sorted order and their indices
+    into self.codes in the same order, so a bucket is a range of both.
+    """
+    if self.table_bits is None:
+      return
+    keys = self._keys(self.codes)
+    order = np.argsort(keys, axis=1, kind='stable')
+    self.tables = (np.take_along_axis(keys, order, axis=1),
+                   order.astype(np.min_scalar_type(max(keys.shape[1] - 1, 0))))
+
+
+  def candidates(self, X, num_candidates, memory_budget=2**27,
+                 min_candidates=1, rows=None, extra=None):
+    """
+    Return the indices into self.codes, of shape (num_test, m) with
+    m <= num_candidates, of the training points that are most likely to be
+    the nearest neighbors of the rows of X. Rows with fewer than m
+    candidates are padded with -1.
+
+    The candidates of a test point are the training points that share a
+    bucket with it in a hash table, and the points extra, of which the
+    num_candidates with the highest asymmetric score are kept. The test
+    points that get fewer than min_candidates of them, or all test points
+    if there are no hash tables, rank every training point instead.
+
+    Inputs:
+    - X: A numpy array of shape (num_test, D) of test points.
+    - num_candidates: Maximum number of candidates per test point.
+    - memory_budget: Approximate number of bytes of working memory to use.
+    - min_candidates: Minimum number of candidates per test point.
+    - rows: If the points in the hash tables have moved since
+      build_tables(), rows[i] is the index into self.codes of the ith of
+      them, or -1 if it has been removed; see KNN.remove().
+    - extra: Indices into self.codes of points that are not in the hash
+      tables, which are candidates of every test point; see KNN.add().
+    """
+    num_test = X.shape[0]
+    num_train = self.codes.shape[0]
+    num_candidates = min(num_candidates, num_train)
+    min_candidates = min(min_candidates, num_candidates)
+    proj = self._project(X)
+    if self.table_bits is None:
+      return self._scan(proj, num_candidates, memory_budget)
+    if self.tables is None:
+      self.build_tables()
+    if extra is None:
+      extra = np.empty(0, dtype=np.int64)
+
+    # Find the bucket of each test point in each table.
+    sorted_keys, order = self.tables
+    num_tables, table_size = order.shape
+    keys = self._keys(np.packbits(proj > 0, axis=1))
+    lo = np.empty((num_test, num_tables), dtype=np.int64)
+    hi = np.empty((num_test, num_tables), dtype=np.int64)
+    for t in range(num_tables):
+      lo[:, t] = np.searchsorted(sorted_keys[t], keys[t], side='left')
+      hi[:, t] = np.searchsorted(sorted_keys[t], keys[t], side='right')
+    bucket_sizes = hi - lo
+
+    # Process the test points in tiles that make about memory_budget bytes
+    # of (test point, candidate) pairs.
+    num_bytes = self.codes.shape[1]
+    test_cost = (bucket_sizes.sum(axis=1) + extra.shape[0])*64 + num_bytes*1024
+    cost = np.cumsum(test_cost)
+    candidates = np.full((num_test, num_candidates), -1, dtype=np.int64)
+    num_found = np.empty(num_test, dtype=np.int64)
+    i = 0
+    while i < num_test:
+      j = max(np.searchsorted(cost, cost[i] - test_cost[i] + memory_budget,
+                              side='right'), i + 1)
+      tile = j - i
+      # Gather the contents of the buckets: entry h of the bucket of test
+      # point q in table t is order[t, lo[q, t] + h].
+      sizes = bucket_sizes[i:j].ravel()
+      total = sizes.sum()
+      starts = (lo[i:j] + table_size*np.arange(num_tables)).ravel()
+      offsets = np.repeat(starts - (np.cumsum(sizes) - sizes), sizes)
+      idx = order.ravel()[offsets + np.arange(total)].astype(np.int64)
+      query = np.repeat(np.arange(tile), bucket_sizes[i:j].sum(axis=1))
+      if rows is not None:
+        idx = rows[idx]
+        query, idx = query[idx >= 0], idx[idx >= 0]
+      query = np.concatenate((query, np.repeat(np.arange(tile),
+                                               extra.shape[0])))
+      idx = np.concatenate((idx, np.tile(extra, tile)))
+      pairs = np.unique(query*num_train + idx)
+      query, idx = pairs // num_train, pairs % num_train
+
+      # Score the pairs a byte of the codes at a time and keep the best
+      # num_candidates of each test point.
+      lut = self._lut(proj[i:j]).ravel()
+      score = np.zeros(pairs.shape[0], dtype=np.float32)
+      for b in range(num_bytes):
+        score += lut[(query*num_bytes + b)*256 + self.codes[idx, b]]
+      ranked = np.lexsort((idx, -score, query))
+      query, idx = query[ranked], idx[ranked]
+      found = np.bincount(query, minlength=tile)
+      rank = np.arange(query.shape[0]) - (np.cumsum(found) - found)[query]
+      best = rank < num_candidates
+      candidates[i + query[best], rank[best]] = idx[best]
+      num_found[i:j] = found
+      i = j
+
+    short = np.flatnonzero(num_found < min_candidates)
+    if short.shape[0] > 0:
+      candidates[short] = self._scan(proj[short], num_candidates,
+                                     memory_budget)
+      num_found[short] = num_candidates
+    return candidates[:, :min(np.max(num_found, initial=0), num_candidates)]
+
+
+  def _scan(self, proj, num_candidates, memory_budget):
+    """
+    Return the indices, of shape (num_test, num_candidates), of the training
+    points with the highest asymmetric score against each row of proj among
+    all of self.codes. The training codes are unpacked a tile at a time and
+    each tile is scored against all test points before moving on.
+    """
+    num_test = proj.shape[0]
+    num_train = self.codes.shape[0]
+    test_tile, train_tile = _tile_shape(num_test, num_train, num_candidates,
+                                        memory_budget)
+    test_starts = range(0, num_test, test_tile)
+    best = [(np.empty((proj[i:i + test_tile].shape[0], 0), dtype=np.float32),
+             np.empty((proj[i:i + test_tile].shape[0], 0), dtype=np.int64))
+            for i in test_starts]
+    for j in range(0, num_train, train_tile):
+      train_signs = self._signs(self.codes[j:j + train_tile])
+      idx = np.arange(j, j + train_signs.shape[0])
+      for t, i in enumerate(test_starts):
+        d = -proj[i:i + test_tile].dot(train_signs.T)
+        best[t] = _merge_topk(best[t][0], best[t][1], d, idx, num_candidates)
+
+    candidates = np.empty((num_test, num_candidates), dtype=np.int64)
+    for t, i in enumerate(test_starts):
+      candidates[i:i + test_tile] = best[t][1]
+    return candidates
+
+
+# State of a KNN.query worker process, set by _init_knn_worker
+_knn_worker = {}
+
+
+def _init_knn_worker(arrays, index):
+  knn = KNN()
+  for name, (shared, dtype, shape) in arrays.items():
+    setattr(knn, name, np.frombuffer(shared, dtype=dtype,
+                                     count=int(np.prod(shape))).reshape(shape))
+  if 'X_dot' not in arrays:
+    knn.X_dot = knn.X_train
+  for name, value in index.items():
+    setattr(knn, name, value)
+  _knn_worker['knn'] = knn
+
+
+def _query_chunk(args):
+  """ find the nearest neighbors of a chunk of test points starting at start """
+  start, X, kwargs = args
+  dists, neighbors = _knn_worker['knn'].query(X, **kwargs)
+  return start, dists, neighbors
+
+
+def _sq_norms(X):
+  """
+  Return the squared L2 norms of the rows of X, accumulated in float64.
+  """
+  return np.einsum('ij,ij->i', X, X, dtype=np.float64)
+
+
+def _check_metric(metric):
+  if metric not in METRICS:
+    raise ValueError('Unknown metric "%s"; choose one of %s'
+                     % (metric, ', '.join(METRICS)))
+
+
+def _tile_bytes(metric):
+  """
+  Return the approximate number of bytes of working memory per element of a
+  distance tile under metric; see _tile_shape().
+  """
+  if metric in ('l2', 'cosine'):
+    return 40
+  return 64
+
+
+def _tile_shape(num_test, num_train, k, memory_budget, tile_bytes=40):
+  """
+  Choose the number of test and training points per distance tile so that a
+  tile and the temporaries of a top-k merge fit in memory_budget bytes. Each
+  tile element costs tile_bytes: about 40 for the distance itself, the
+  product it is computed from, and the merged distances, indices and
+  argpartition output, plus the temporaries of metrics that are not computed
+  with a matrix product.
+  """
+  elems = max(memory_budget // tile_bytes, 1)
+  test_tile = int(min(num_test, max(np.sqrt(elems), 1)))
+  train_tile = int(min(num_train, max(elems // max(test_tile, 1), k)))
+  return max(test_tile, 1), max(train_tile, 1)
+
+
+def _merge_topk(best_d, best_i, d, idx, k):
+  """
+  Merge a tile of distances d of shape (n, m) to the training points idx of
+  shape (m,) or (n, m) into the running top-k best_d, best_i of shape
+  (n, <= k) and return the new, unsorted, top-k.
+
+  Points tied with the kth smallest distance are kept in order of their
+  index, so the top-k does not depend on how the training set is tiled.
+  """
+  cand_d = np.hstack((best_d, d))
+  cand_i = np.hstack((best_i, np.broadcast_to(idx, d.shape)))
+  if cand_d.shape[1] <= k:
+    return cand_d, cand_i
+  part = np.argpartition(cand_d, k - 1, axis=1)[:, :k]
+  rows = np.arange(cand_d.shape[0]).reshape(-1, 1)
+  kth = np.max(cand_d[rows, part], axis=1).reshape(-1, 1)
+  for r in np.flatnonzero(np.count_nonzero(cand_d <= kth, axis=1) > k):
+    part[r] = np.lexsort((cand_i[r], cand_d[r]))[:k]
+  return cand_d[rows, part], cand_i[rows, part]
+
+
+def _sort_topk(best_d, best_i):
+  """
+  Sort each row of a top-k by increasing distance, breaking ties between
+  equally distant training points by the smaller index.
+  """
+  order = np.lexsort((best_i, best_d), axis=1)
+  rows = np.arange(best_d.shape[0]).reshape(-1, 1)
+  return best_d[rows, order], best_i[rows, order]
+
+
+def _majority_vote(closest_y):
+  """
+  Return the most common label in each row of closest_y, of shape
+  (num_test, k), breaking ties by choosing the smaller label.
+
+  The labels are mapped to 0, ..., num_labels - 1 in sorted order and row i
+  is offset by i * num_labels, so that a single bincount counts the labels
+  of every row; argmax then returns the first, i.e. smallest, of the most
+  common labels.
+  """
+  num_test = closest_y.shape[0]
+  labels, codes = np.unique(closest_y, return_inverse=True)
+  num_labels = labels.shape[0]
+  codes = codes.reshape(num_test, -1) + num_labels*np.arange(num_test).reshape(-1, 1)
+  counts = np.bincount(codes.ravel(), minlength=num_test*num_labels)
+  return labels[np.argmax(counts.reshape(num_test, num_labels), axis=1)]
@@ -4,6 +4,8 @@ class Softmax(object):
 
   def __init__(self, dims=[10, 3073]):
     self.init_weights(dims=dims)
+    # Buffers reused by train across iterations.
+    self._workspace = {}
 
   def init_weights(self, dims):
     """
@@ -114,23 +116,54 @@ class Softmax(object):
     A vectorized implementation of loss_and_grad. It shares the same
 	inputs and ouptuts as loss_and_grad.
     """
+    num_train = X.shape[0]
+    score = np.empty((num_train, self.W.shape[0]), dtype=self.W.dtype)
+    grad = np.empty(self.W.shape, dtype=self.W.dtype)
+    return self._loss_and_grad_into(X, y, score, grad)
+
+  def _sgd_step(self, X, y, learning_rate):
+    """
+    Take one gradient descent step on the batch (X, y) and return its loss.
+    The scores, probabilities and gradient are computed in workspace
+    buffers that are reused by the next step with the same batch size.
+    """
+    score = self._buffer('score', (X.shape[0], self.W.shape[0]), self.W.dtype)
+    grad = self._buffer('grad', self.W.shape, self.W.dtype)
+    loss, grad = self._loss_and_grad_into(X, y, score, grad)
+    grad *= learning_rate
+    self.W -= grad
+    return loss
+
+  def _loss_and_grad_into(self, X, y, score, grad):
+    """
+    fast_loss_and_grad computed in place in score, of shape (N, C), and
+    grad, of shape (C, D), both in the datatype of self.W.
+    """
     loss = 0.0
-    grad = np.zeros(self.W.shape) # initialize the gradient as zero
+    num_train = X.shape[0]
+    rows = np.arange(num_train)
+    X = X.astype(self.W.dtype, copy=False)
+    a = score
   
     # ================================================================ #
     # YOUR CODE HERE:
 	#   Calculate the softmax loss and gradient WITHOUT any for loops.
     # ================================================================ #
     
-    a = X.dot(self.W.T)
+    np.dot(X, self.W.T, out=a)
     a -= np.max(a, axis=1, keepdims=True)
-    score = np.exp(a)/np.sum(np.exp(a), axis=1, keepdims=True)
-    loss = np.sum(-np.log(score[np.arange(X.shape[0]), y]))
-    
-    score[range(y.shape[0]),y] -= 1
-    grad = score.T.dot(X)
-    grad /= y.shape[0]
-    loss /= y.shape[0]
+    # -log(softmax) of the correct class is log(sum(exp(a))) - a[y], which
+    # needs a[y] before a is exponentiated in place.
+    loss = -np.sum(a[rows, y], dtype=np.float64)
+    score = np.exp(a, out=a)
+    sums = np.sum(score, axis=1, keepdims=True)
+    loss += np.sum(np.log(sums), dtype=np.float64)
+    score /= sums
+
+    score[rows,y] -= 1
+    np.dot(score.T, X, out=grad)
+    grad /= num_train
+    loss /= num_train
     
     # ================================================================ #
     # END YOUR CODE HERE
@@ -139,7 +172,7 @@ class Softmax(object):
     return loss, grad
 
   def train(self, X, y, learning_rate=1e-3, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, dtype=None):
     """
     Train this linear classifier using stochastic gradient descent.
 
@@ -152,6 +185,8 @@ class Softmax(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - dtype: Datatype to train in, e.g. np.float32 for faster matrix
+      products; defaults to the datatype of the initial weights (float64).
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
@@ -160,9 +195,13 @@ class Softmax(object):
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
 
     self.init_weights(dims=[np.max(y) + 1, X.shape[1]])	# initializes the weights of self.W
+    if dtype is not None:
+      self.W = self.W.astype(dtype)
 
     # Run stochastic gradient descent to optimize W
     loss_history = []
+    X_buffer = self._buffer('X_batch', (batch_size, dim), self.W.dtype)
+    y_buffer = self._buffer('y_batch', (batch_size,), y.dtype)
 
     for it in np.arange(num_iters):
       X_batch = None
@@ -179,22 +218,25 @@ class Softmax(object):
 	  #   replacement.
       # ================================================================ #
       idx = np.random.choice(np.arange(num_train), batch_size)
-      X_batch = X[idx]
-      y_batch = y[idx]
+      if X.dtype == X_buffer.dtype:
+        X_batch = np.take(X, idx, axis=0, out=X_buffer, mode='clip')
+      else:
+        X_buffer[...] = X[idx]
+        X_batch = X_buffer
+      y_batch = np.take(y, idx, out=y_buffer, mode='clip')
       # ================================================================ #
       # END YOUR CODE HERE
       # ================================================================ #
 
-      # evaluate loss and gradient
-      loss, grad = self.fast_loss_and_grad(X_batch, y_batch)
-      loss_history.append(loss)
-
       # ================================================================ #
       # YOUR CODE HERE:
       #   Update the parameters, self.W, with a gradient step 
       # ================================================================ #
-      
-      self.W -= learning_rate * grad
+
+      # Evaluates the loss and gradient in workspace buffers and updates
+      # self.W in place.
+      loss = self._sgd_step(X_batch, y_batch, learning_rate)
+      loss_history.append(loss)
 
 	  # ================================================================ #
       # END YOUR CODE HERE
@@ -205,6 +247,16 @@ class Softmax(object):
 
     return loss_history
 
+  def _buffer(self, name, shape, dtype):
+    """
+    Return the workspace array called name, reusing the one from the
+    previous call if it has the same shape and dtype.
+    """
+    buf = self._workspace.get(name)
+    if buf is None or buf.shape != shape or buf.dtype != dtype:
+      buf = self._workspace[name] = np.empty(shape, dtype=dtype)
+    return buf
+
   def predict(self, X):
     """
     Inputs:
@@ -0,0 +1,140 @@
+from __future__ import print_function, division
+from builtins import object
+
+import numpy as np
+
+
+"""
+Data augmentation for minibatches of images of shape (N, C, H, W). Every
+function here operates on the whole minibatch at once with vectorized numpy
+operations, drawing one set of random parameters per image from rng.
+"""
+
+
+def random_crop(X, pad, rng=np.random):
+    """
+    Zero-pad every image by pad pixels on each side and crop a random window
+    of the original size out of it.
+
+    Inputs:
+    - X: Array of shape (N, C, H, W)
+    - pad: Number of pixels of padding
+    - rng: np.random.RandomState to draw the crop offsets from
+
+    Returns:
+    - out: New array of shape (N, C, H, W)
+    """
+    N, C, H, W = X.shape
+    X_pad = np.pad(X, ((0, 0), (0, 0), (pad, pad), (pad, pad)), 'constant')
+    rows = rng.randint(0, 2 * pad + 1, size=N)[:, None] + np.arange(H)
+    cols = rng.randint(0, 2 * pad + 1, size=N)[:, None] + np.arange(W)
+    return X_pad[np.arange(N)[:, None, None, None],
+                 np.arange(C)[None, :, None, None],
+                 rows[:, None, :, None],
+                 cols[:, None, None, :]]
+
+
+def horizontal_flip(X, p=0.5, rng=np.random):
+    """
+    Mirror each image left to right with probability p, modifying X in place.
+    """
+    flip = rng.rand(X.shape[0]) < p
+    X[flip] = X[flip, :, :, ::-1]
+    return X
+
+
+def color_jitter(X, brightness=0, contrast=0, saturation=0, rng=np.random):
+    """
+    Randomly perturb the colors of each image, modifying X in place.
+
+    Inputs:
+    - X: Array of shape (N, 3, H, W)
+    - brightness: Each image is shifted by an offset drawn uniformly from
+      [-brightness, brightness], in the units of X.
+    - contrast: Each image is scaled about its mean by a factor drawn
+      uniformly from [1 - contrast, 1 + contrast].
+    - saturation: Each pixel is scaled about its gray level (the mean over
+      channels) by a factor drawn uniformly from
+      [1 - saturation, 1 + saturation].
+    - rng: np.random.RandomState to draw the perturbations from
+    """
+    N = X.shape[0]
+    if saturation > 0:
+        factor = rng.uniform(1 - saturation, 1 + saturation, size=(N, 1, 1, 1))
+        gray = X.mean(axis=1, keepdims=True)
+        X -= gray
+        X *= factor.astype(X.dtype)
+        X += gray
+    if contrast > 0:
+        factor = rng.uniform(1 - contrast, 1 + contrast, size=(N, 1, 1, 1))
+        mean = X.mean(axis=(1, 2, 3), keepdims=True)
+        X -= mean
+        X *= factor.astype(X.dtype)
+        X += mean
+    if brightness > 0:
+        X += rng.uniform(-brightness, brightness,
+                         size=(N, 1, 1, 1)).astype(X.dtype)
+    return X
+
+
+class Augmenter(object):
+    """
+    An Augmenter applies random crops, horizontal flips and color jitter to
+    minibatches of images of shape (N, C, H, W). It is called with a
+    minibatch (X, y) and returns an augmented copy of X together with y, so
+    it can be passed to Solver as its augment argument.
+
+    Augmenters hold no state besides their RandomState and can be pickled,
+    so they can also be sent to worker processes. Every copy then starts
+    from the same RandomState and would draw the same parameters, so each
+    worker should call reseed(worker_id) with its own id before use.
+
+    Example usage:
+
+    augment = Augmenter(crop_pad=4, flip=True, brightness=10)
+    solver = Solver(model, data, augment=augment, prefetch=2)
+    """
+
+    def __init__(self, crop_pad=0, flip=False, brightness=0, contrast=0,
+                 saturation=0, seed=None):
+        """
+        Inputs:
+        - crop_pad: If positive, pad images by this many pixels and take a
+          random crop of the original size (see random_crop).
+        - flip: If True, mirror half of the images left to right.
+        - brightness, contrast, saturation: Strength of the color jitter (see
+          color_jitter); 0 disables each of them.
+        - seed: Seed for the RandomState used to draw all random parameters.
+        """
+        self.seed = seed
+        self.crop_pad = crop_pad
+        self.flip = flip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+        self.rng = np.random.RandomState(seed)
+
+    def reseed(self, worker_id):
+        """
+        Give this copy of the Augmenter a RandomState of its own, derived
+        from seed and worker_id with np.random.SeedSequence, so that copies
+        in different workers draw independent streams. If seed is None the
+        streams are seeded from fresh entropy.
+        """
+        seq = np.random.SeedSequence(self.seed, spawn_key=(worker_id,))
+        self.rng = np.random.RandomState(seq.generate_state(4))
+
+    def __call__(self, X, y):
+        """
+        Return an augmented copy of the minibatch X and the unchanged labels y.
+        """
+        if self.crop_pad > 0:
+            X = random_crop(X, self.crop_pad, rng=self.rng)
+        else:
+            X = X.copy()
+        if self.flip:
+            horizontal_flip(X, rng=self.rng)
+        if self.brightness > 0 or self.contrast > 0 or self.saturation > 0:
+            color_jitter(X, self.brightness, self.contrast, self.saturation,
+                         rng=self.rng)
+        return X, y
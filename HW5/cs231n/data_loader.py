@@ -0,0 +1,311 @@
+from __future__ import print_function, division
+from builtins import object
+import json
+import os
+import threading
+
+from six.moves import queue
+import numpy as np
+
+
+def random_batches(rng, num_train, batch_size):
+    """
+    Generate an endless stream of minibatch indices sampled with replacement.
+
+    Inputs:
+    - rng: np.random.RandomState (or the np.random module) to sample from
+    - num_train: Number of training examples
+    - batch_size: Number of indices per minibatch
+    """
+    while True:
+        yield rng.choice(num_train, batch_size)
+
+
+def epoch_batches(rng, num_train, batch_size):
+    """
+    Generate an endless stream of minibatch indices sampled without
+    replacement: each epoch draws a fresh permutation of the training set and
+    cuts it into consecutive minibatches, so every example is visited once
+    per epoch. The num_train % batch_size examples left over at the end of a
+    permutation are skipped for that epoch. Indices are sorted within each
+    minibatch so that gathering them reads memory in order.
+    """
+    num_batches = max(num_train // batch_size, 1)
+    while True:
+        perm = rng.permutation(num_train)
+        for i in range(num_batches):
+            yield np.sort(perm[i * batch_size:(i + 1) * batch_size])
+
+
+def block_batches(rng, num_train, batch_size, block_size=None):
+    """
+    Like epoch_batches, but shuffles contiguous blocks of block_size examples
+    instead of individual examples: each epoch visits the blocks in a random
+    order and shuffles the examples within each block. Every minibatch then
+    comes from one or two blocks, which keeps reads nearly sequential for
+    memory mapped data. block_size defaults to 10 * batch_size.
+    """
+    if block_size is None:
+        block_size = 10 * batch_size
+    num_batches = max(num_train // batch_size, 1)
+    block_starts = np.arange(0, num_train, block_size)
+    while True:
+        order = np.concatenate([
+            start + rng.permutation(min(block_size, num_train - start))
+            for start in rng.permutation(block_starts)])
+        for i in range(num_batches):
+            yield np.sort(order[i * batch_size:(i + 1) * batch_size])
+
+
+def gather_batch(X, y, idx, X_out, y_out, mean_image=None):
+    """
+    Copy the rows idx of X and y into the preallocated buffers X_out and
+    y_out. Integer data is converted to the dtype of X_out on the way and has
+    mean_image subtracted if it is not None.
+    """
+    if np.issubdtype(X.dtype, np.integer) and X_out.dtype != X.dtype:
+        X_out[...] = X[idx]
+        if mean_image is not None:
+            X_out -= mean_image
+    elif isinstance(X, ShardedDataset):
+        X_out[...] = X[idx]
+    else:
+        np.take(X, idx, axis=0, out=X_out)
+    np.take(y, idx, out=y_out)
+
+
+def write_shards(directory, shards):
+    """
+    Write a dataset to disk as a sequence of shards that can be opened with
+    ShardedDataset. Shards are written one at a time, so a dataset larger
+    than memory can be produced by a generator.
+
+    Inputs:
+    - directory: Directory to write the shards to; it is created if needed.
+    - shards: Iterable of tuples (X, y), each holding one shard of data of
+      shape (N_i, d_1, ..., d_k) and labels of shape (N_i,).
+
+    Returns:
+    - dataset: A ShardedDataset over the written shards.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    index = []
+    for i, (X, y) in enumerate(shards):
+        X_file, y_file = 'X_%05d.npy' % i, 'y_%05d.npy' % i
+        np.save(os.path.join(directory, X_file), X)
+        np.save(os.path.join(directory, y_file), y)
+        index.append({'X': X_file, 'y': y_file, 'size': int(X.shape[0])})
+    with open(os.path.join(directory, 'index.json'), 'w') as f:
+        json.dump({'shards': index}, f)
+    return ShardedDataset(directory)
+
+
+class ShardedDataset(object):
+    """
+    A ShardedDataset is a dataset stored on disk as a sequence of shards
+    written by write_shards. The image shards are opened with memory mapping
+    as they are first touched, so only the parts that are read occupy memory;
+    the labels of all shards are small and are held in memory as self.y.
+
+    A ShardedDataset can be indexed like an array with an index array or a
+    slice, returning an in-memory array, and can be passed to Solver as
+    data['X_train'] (with data['y_train'] = dataset.y) or data['X_val'].
+    Solver then draws its minibatches with batch_indices, which reads only a
+    window of a few shards at a time.
+    """
+
+    def __init__(self, directory):
+        """
+        Open the shards in directory.
+        """
+        self.directory = directory
+        with open(os.path.join(directory, 'index.json'), 'r') as f:
+            self.shards = json.load(f)['shards']
+        sizes = [shard['size'] for shard in self.shards]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)]).astype(np.int64)
+        self.num_shards = len(self.shards)
+        self.y = np.concatenate([
+            np.load(os.path.join(directory, shard['y']))
+            for shard in self.shards])
+        self._X_shards = [None] * self.num_shards
+        first = self.shard_X(0)
+        self.shape = (int(self.offsets[-1]),) + first.shape[1:]
+        self.dtype = first.dtype
+
+
+    def __len__(self):
+        return self.shape[0]
+
+
+    def shard_X(self, i):
+        """
+        Return the data of shard i as a read-only np.memmap.
+        """
+        if self._X_shards[i] is None:
+            self._X_shards[i] = np.load(
+                os.path.join(self.directory, self.shards[i]['X']), mmap_mode='r')
+        return self._X_shards[i]
+
+
+    def __getitem__(self, idx):
+        """
+        Gather the rows idx (an index array or a slice) of the dataset into
+        a new array, reading each shard once.
+        """
+        if isinstance(idx, slice):
+            idx = np.arange(*idx.indices(len(self)))
+        idx = np.asarray(idx)
+        out = np.empty((idx.shape[0],) + self.shape[1:], dtype=self.dtype)
+        shard_ids = np.searchsorted(self.offsets, idx, side='right') - 1
+        for i in np.unique(shard_ids):
+            mask = shard_ids == i
+            out[mask] = self.shard_X(i)[idx[mask] - self.offsets[i]]
+        return out
+
+
+    def batch_indices(self, rng, batch_size, shards_per_window=2):
+        """
+        Generate an endless stream of minibatch indices that shuffles across
+        and within shards while touching only a few shards at a time: each
+        epoch visits the shards in a random order, shards_per_window at a
+        time, and shuffles the examples of the shards in a window together.
+        Like epoch_batches, every example is visited once per epoch and
+        indices are sorted within each minibatch.
+        """
+        num_batches = max(len(self) // batch_size, 1)
+        while True:
+            order = rng.permutation(self.num_shards)
+            windows = []
+            for start in range(0, self.num_shards, shards_per_window):
+                window = np.concatenate([
+                    np.arange(self.offsets[i], self.offsets[i + 1])
+                    for i in order[start:start + shards_per_window]])
+                windows.append(window[rng.permutation(window.shape[0])])
+            perm = np.concatenate(windows)
+            for i in range(num_batches):
+                yield np.sort(perm[i * batch_size:(i + 1) * batch_size])
+
+
+class PrefetchLoader(object):
+    """
+    A PrefetchLoader gathers minibatches on a background thread, so that
+    indexing into the training set (and converting integer images to float)
+    overlaps with the forward and backward pass on the main thread.
+
+    Batches are written into a ring of preallocated buffers: prefetch of them
+    are filled ahead of time while one more is held by the consumer. The
+    arrays returned by next() are views of these buffers and are only valid
+    until the following call to next(), which hands the buffer back to the
+    background thread.
+
+    Example usage:
+
+    loader = PrefetchLoader(X, y, batch_indices, batch_size=100, prefetch=2)
+    for X_batch, y_batch in loader:
+        loss, grads = model.loss(X_batch, y_batch)
+    loader.close()
+    """
+
+    def __init__(self, X, y, batch_indices, batch_size, prefetch=2, dtype=None,
+                 mean_image=None, transform=None):
+        """
+        Construct a new PrefetchLoader and start its background thread.
+
+        Inputs:
+        - X: Array of shape (N, d_1, ..., d_k) of data, which may be a np.memmap
+        - y: Array of shape (N,) of labels
+        - batch_indices: Iterable of index arrays, each of length at most
+          batch_size, giving the rows of X and y that form each minibatch.
+        - batch_size: Size of the preallocated buffers.
+        - prefetch: Number of minibatches to gather ahead of the consumer.
+        - dtype: Datatype to convert integer data to; defaults to np.float64.
+          Floating point data is gathered without conversion.
+        - mean_image: If not None, subtracted from integer data after it is
+          converted to dtype.
+        - transform: If not None, a function called on the background thread
+          as transform(X_batch, y_batch) that returns the minibatch to hand
+          out, e.g. an Augmenter.
+        """
+        if prefetch < 1:
+            raise ValueError('prefetch must be at least 1, got %d' % prefetch)
+        self.X = X
+        self.y = y
+        self.batch_indices = batch_indices
+        self.mean_image = mean_image
+        self.transform = transform
+        if not np.issubdtype(X.dtype, np.integer):
+            dtype = X.dtype
+        elif dtype is None:
+            dtype = np.float64
+
+        num_buffers = prefetch + 1
+        self._X_bufs = [np.empty((batch_size,) + X.shape[1:], dtype=dtype)
+                        for _ in range(num_buffers)]
+        self._y_bufs = [np.empty(batch_size, dtype=y.dtype)
+                        for _ in range(num_buffers)]
+
+        self._free = queue.Queue()
+        self._ready = queue.Queue()
+        for i in range(num_buffers):
+            self._free.put(i)
+        self._held = None
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def _produce(self):
+        """
+        Body of the background thread: fill free buffers with the next
+        minibatch until batch_indices is exhausted or close() is called.
+        Exceptions are passed on to the consumer.
+        """
+        try:
+            for idx in self.batch_indices:
+                slot = self._free.get()
+                if self._stop.is_set():
+                    return
+                n = len(idx)
+                X_batch, y_batch = self._X_bufs[slot][:n], self._y_bufs[slot][:n]
+                gather_batch(self.X, self.y, idx, X_batch, y_batch,
+                             self.mean_image)
+                if self.transform is not None:
+                    X_batch, y_batch = self.transform(X_batch, y_batch)
+                self._ready.put((slot, X_batch, y_batch))
+            self._ready.put(None)
+        except Exception as e:
+            self._ready.put(e)
+
+
+    def __iter__(self):
+        return self
+
+
+    def __next__(self):
+        """
+        Return the next minibatch as a tuple (X_batch, y_batch).
+        """
+        if self._held is not None:
+            self._free.put(self._held)
+            self._held = None
+        item = self._ready.get()
+        if item is None:
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        slot, X_batch, y_batch = item
+        self._held = slot
+        return X_batch, y_batch
+
+    next = __next__
+
+
+    def close(self):
+        """
+        Stop the background thread. The loader cannot be used afterwards.
+        """
+        self._stop.set()
+        self._free.put(None)
+        self._thread.join()
@@ -1,12 +1,23 @@
 from __future__ import print_function
 from past.builtins import xrange
 
-import matplotlib
+import functools
+import hashlib
+import itertools
+import json
+import multiprocessing
+import numbers
+import os
+import sys
+import sysconfig
+import types
+
 import numpy as np
 from scipy.ndimage import uniform_filter
 
 
-def extract_features(imgs, feature_fns, verbose=False):
+def extract_features(imgs, feature_fns, verbose=False, num_workers=1,
+                     chunk_size=None, cache_dir=None, data_key=None):
   """
   Given pixel data for images and several feature functions that can operate on
   single images, apply all feature functions to all images, concatenating the
@@ -19,6 +30,29 @@ def extract_features(imgs, feature_fns, verbose=False):
     take as input an H x W x D array and return a (one-dimensional) array of
     length F_i.
   - verbose: Boolean; if true, print progress.
+  - num_workers: If greater than 1, split the images into chunks of
+    chunk_size images and extract their features on a pool of this many
+    processes, which write straight into a shared-memory output matrix.
+    Forked workers inherit imgs; otherwise imgs is copied into shared memory
+    once. Either way tasks only name the rows they cover.
+    Unless processes are started by forking (the default on Linux), the
+    feature functions must be picklable, e.g. module-level functions or
+    functools.partial objects rather than lambdas.
+  - chunk_size: Number of images per task when num_workers > 1; defaults to
+    splitting the images into 4 chunks per worker.
+  - cache_dir: If not None, the features are cached in this directory as a
+    .npy file named after a hash of the images and of the feature functions
+    (their code, default and bound arguments, the attributes of callable
+    objects, and the values of the globals they use, such as the nbin passed
+    to color_histogram_hsv). When the same images and feature functions are
+    seen again the cached features are returned as a copy-on-write
+    np.memmap, which can be modified in memory like the array returned
+    otherwise; changing either one invalidates the cache entry. A
+    ValueError is raised if a feature function uses a value that cannot be
+    described for the key.
+  - data_key: String identifying the images for the cache instead of
+    hashing their contents, e.g. the path of the file they were loaded from
+    (whose modification time and size then become part of the key).
 
   Returns:
   An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
@@ -28,6 +62,21 @@ def extract_features(imgs, feature_fns, verbose=False):
   if num_images == 0:
     return np.array([])
 
+  if cache_dir is not None:
+    cache_file = os.path.join(cache_dir, '%s.npy' % feature_cache_key(
+        imgs, feature_fns, data_key=data_key))
+    if os.path.isfile(cache_file):
+      return np.load(cache_file, mmap_mode='c')
+    imgs_features = extract_features(imgs, feature_fns, verbose=verbose,
+                                     num_workers=num_workers,
+                                     chunk_size=chunk_size)
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+    with open(cache_file + '.tmp', 'wb') as f:
+      np.save(f, imgs_features)
+    os.rename(cache_file + '.tmp', cache_file)
+    return imgs_features
+
   # Use the first image to determine feature dimensions
   feature_dims = []
   first_image_features = []
@@ -40,22 +89,295 @@ def extract_features(imgs, feature_fns, verbose=False):
   # Now that we know the dimensions of the features, we can allocate a single
   # big array to store all features as columns.
   total_feature_dim = sum(feature_dims)
-  imgs_features = np.zeros((num_images, total_feature_dim))
+  if num_workers > 1:
+    shared = multiprocessing.RawArray('d', num_images * total_feature_dim)
+    imgs_features = np.frombuffer(shared).reshape(num_images, total_feature_dim)
+  else:
+    imgs_features = np.zeros((num_images, total_feature_dim))
   imgs_features[0] = np.hstack(first_image_features).T
 
+  if num_workers > 1:
+    # Extract features for the rest of the images in parallel. Workers only
+    # report how many images they finished; the features themselves never
+    # travel back through a pipe.
+    if chunk_size is None:
+      chunk_size = max(1, (num_images - 1) // (4 * num_workers) + 1)
+    if multiprocessing.get_start_method() == 'fork':
+      worker_imgs = imgs
+    else:
+      shared_imgs = multiprocessing.RawArray('b', max(imgs.nbytes, 1))
+      np.frombuffer(shared_imgs, dtype=imgs.dtype,
+                    count=imgs.size).reshape(imgs.shape)[...] = imgs
+      worker_imgs = (shared_imgs, imgs.dtype.str, imgs.shape)
+    chunks = ((start, min(start + chunk_size, num_images))
+              for start in xrange(1, num_images, chunk_size))
+    pool = multiprocessing.Pool(num_workers, initializer=_init_feature_worker,
+                                initargs=(shared, imgs_features.shape,
+                                          worker_imgs, feature_fns,
+                                          feature_dims))
+    try:
+      done = 1
+      for count in pool.imap_unordered(_extract_feature_chunk, chunks):
+        done += count
+        if verbose:
+          print('Done extracting features for %d / %d images' % (done, num_images))
+    finally:
+      pool.close()
+      pool.join()
+    return imgs_features
+
   # Extract features for the rest of the images.
   for i in xrange(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
+    _fill_features(imgs[i], imgs_features[i], feature_fns, feature_dims)
     if verbose and i % 1000 == 0:
       print('Done extracting features for %d / %d images' % (i, num_images))
 
   return imgs_features
 
 
+def extract_features_to_file(imgs, feature_fns, filename, num_images=None,
+                             chunk_size=1000, dtype=np.float32, verbose=False):
+  """
+  Streaming version of extract_features for datasets that do not fit in
+  memory: images are consumed one chunk at a time and their features are
+  written to a memory mapped .npy file, so neither the images nor the
+  features are ever held in memory in full.
+
+  Progress is recorded in filename + '.progress' after every chunk. If the
+  extraction is interrupted, calling this function again with the same
+  arguments skips the images that were already done and carries on where it
+  stopped. Once the file is complete, further calls just open it.
+
+  Inputs:
+  - imgs: Either an N x H x W x C array of pixel data (typically a
+    np.memmap), read chunk_size images at a time, or an iterable of arrays
+    of shape (n_i, H, W, C) giving the images chunk by chunk; in that case
+    num_images must be given. On resume, an iterable must produce the same
+    images in the same order.
+  - feature_fns: List of feature functions, as for extract_features.
+  - filename: Path of the .npy file to write the features to.
+  - num_images: Total number of images; only needed when imgs is an
+    iterable.
+  - chunk_size: Number of images per chunk when imgs is an array.
+  - dtype: Datatype of the stored features.
+  - verbose: Boolean; if true, print progress.
+
+  Returns:
+  A read-only np.memmap of shape (N, F_1 + ... + F_k) holding the features.
+  """
+  progress_file = filename + '.progress'
+  if os.path.isfile(filename) and not os.path.isfile(progress_file):
+    return np.load(filename, mmap_mode='r')
+
+  if hasattr(imgs, 'shape'):
+    num_images = imgs.shape[0]
+    chunks = (imgs[start:start + chunk_size]
+              for start in xrange(0, num_images, chunk_size))
+  elif num_images is None:
+    raise ValueError('num_images is required when imgs is an iterable')
+  else:
+    chunks = iter(imgs)
+
+  if os.path.isfile(progress_file):
+    with open(progress_file, 'r') as f:
+      progress = json.load(f)
+    if progress['num_images'] != num_images:
+      raise ValueError('%s was started for %d images, not %d' % (
+        filename, progress['num_images'], num_images))
+    feature_dims = progress['feature_dims']
+    out = np.lib.format.open_memmap(filename, mode='r+')
+  else:
+    # Use the first image to determine feature dimensions
+    first_chunk = next(chunks)
+    chunks = itertools.chain([first_chunk], chunks)
+    feature_dims = [int(feature_fn(first_chunk[0].squeeze()).size)
+                    for feature_fn in feature_fns]
+    progress = {'num_images': num_images, 'feature_dims': feature_dims,
+                'done': 0}
+    _write_progress(progress_file, progress)
+    out = np.lib.format.open_memmap(filename, mode='w+', dtype=dtype,
+                                    shape=(num_images, sum(feature_dims)))
+
+  start = 0
+  for chunk in chunks:
+    end = start + chunk.shape[0]
+    if end > progress['done']:
+      skip = max(progress['done'] - start, 0)
+      for i in xrange(skip, chunk.shape[0]):
+        _fill_features(chunk[i], out[start + i], feature_fns, feature_dims)
+      out.flush()
+      progress['done'] = end
+      _write_progress(progress_file, progress)
+      if verbose:
+        print('Done extracting features for %d / %d images' % (end, num_images))
+    start = end
+
+  if start != num_images:
+    raise ValueError('expected %d images but got %d' % (num_images, start))
+  del out
+  os.remove(progress_file)
+  return np.load(filename, mmap_mode='r')
+
+
+def _write_progress(progress_file, progress):
+  with open(progress_file + '.tmp', 'w') as f:
+    json.dump(progress, f)
+  os.rename(progress_file + '.tmp', progress_file)
+
+
+def feature_cache_key(imgs, feature_fns, data_key=None, chunk_size=1000):
+  """
+  Compute the key under which extract_features caches the features of imgs
+  computed by feature_fns: a hex digest of the images (their contents, or
+  data_key if given) and of _describe_function of every feature function.
+  """
+  h = hashlib.sha1()
+  h.update(repr((imgs.shape, imgs.dtype.str)).encode())
+  if data_key is None:
+    for start in xrange(0, imgs.shape[0], chunk_size):
+      h.update(np.ascontiguousarray(imgs[start:start + chunk_size]).data)
+  else:
+    h.update(repr(data_key).encode())
+    if os.path.isfile(data_key):
+      st = os.stat(data_key)
+      h.update(repr((st.st_mtime, st.st_size)).encode())
+  for feature_fn in feature_fns:
+    h.update(repr(_describe_function(feature_fn)).encode())
+  return h.hexdigest()
+
+
+def _describe_function(obj, seen=None):
+  """
+  Build a description of a feature function (or of a value it uses) that
+  changes whenever its behavior might: for plain functions this covers the
+  bytecode, constants, default arguments and closure, and recursively the
+  module-level values and functions it refers to by name; functools.partial
+  objects are described with their arguments, bound methods with their
+  instance, and other objects, such as callable instances, with their class
+  and attributes. Modules, classes, builtin functions and functions of
+  installed libraries and the standard library are described by name.
+  Raises ValueError for values that cannot be described, which would
+  otherwise let a changed feature function hit a stale cache entry.
+  """
+  if seen is None:
+    seen = set()
+  if isinstance(obj, (numbers.Number, str, bytes, bool, type(None),
+                      np.generic, np.dtype)):
+    return repr(obj)
+  if isinstance(obj, np.ndarray):
+    return ('ndarray', obj.shape, obj.dtype.str,
+            hashlib.sha1(np.ascontiguousarray(obj).data).hexdigest())
+  if isinstance(obj, (types.ModuleType, type, types.BuiltinFunctionType,
+                      np.ufunc)):
+    return ('name', type(obj).__name__, getattr(obj, '__module__', None),
+            getattr(obj, '__qualname__', getattr(obj, '__name__', None)))
+  # Functions and objects may refer to themselves or each other.
+  if id(obj) in seen:
+    return ('cycle', type(obj).__name__, getattr(obj, '__qualname__', None))
+  seen = seen | {id(obj)}
+  if isinstance(obj, (tuple, list)):
+    return [_describe_function(v, seen) for v in obj]
+  if isinstance(obj, (set, frozenset)):
+    return sorted(repr(_describe_function(v, seen)) for v in obj)
+  if isinstance(obj, dict):
+    return sorted((repr(k), _describe_function(v, seen)) for k, v in obj.items())
+  if isinstance(obj, functools.partial):
+    return ('partial', _describe_function(obj.func, seen),
+            _describe_function(obj.args, seen),
+            _describe_function(obj.keywords or {}, seen))
+  if isinstance(obj, types.MethodType):
+    return ('method', _describe_function(obj.__func__, seen),
+            _describe_function(obj.__self__, seen))
+  if isinstance(obj, types.FunctionType) and _is_library(obj.__module__):
+    return ('name', 'function', obj.__module__, obj.__qualname__)
+  if isinstance(obj, types.FunctionType):
+    code = obj.__code__
+    closure = [cell.cell_contents for cell in (obj.__closure__ or ())]
+    names = {}
+    for name in _code_names(code):
+      if name in obj.__globals__:
+        names[name] = _describe_function(obj.__globals__[name], seen)
+    return ('function', obj.__module__, obj.__qualname__, _describe_code(code),
+            _describe_function(obj.__defaults__, seen),
+            _describe_function(obj.__kwdefaults__, seen),
+            _describe_function(closure, seen), sorted(names.items()))
+  if hasattr(obj, '__dict__'):
+    cls = type(obj)
+    call = getattr(cls, '__call__', None)
+    return ('object', cls.__module__, cls.__qualname__,
+            _describe_function(call, seen)
+            if isinstance(call, types.FunctionType) else None,
+            _describe_function(vars(obj), seen))
+  raise ValueError('Cannot describe %r for the feature cache key; pass '
+                   'cache_dir=None to extract features without caching' % (obj,))
+
+
+def _is_library(module_name):
+  """ whether a module is part of the standard library or an installed package """
+  module = sys.modules.get(module_name)
+  filename = getattr(module, '__file__', None)
+  if filename is None:
+    return module_name in sys.builtin_module_names
+  filename = os.path.realpath(filename)
+  return any(filename.startswith(os.path.realpath(path) + os.sep)
+             for path in _LIBRARY_PATHS)
+
+
+_LIBRARY_PATHS = set(sysconfig.get_paths()[name]
+                     for name in ('stdlib', 'platstdlib', 'purelib', 'platlib'))
+
+
+def _code_names(code):
+  """ the global names used by a code object and the code objects nested in it """
+  names = set(code.co_names)
+  for c in code.co_consts:
+    if hasattr(c, 'co_code'):
+      names.update(_code_names(c))
+  return sorted(names)
+
+
+def _describe_code(code):
+  """ describe a code object, including the code objects nested in it """
+  consts = [_describe_code(c) if hasattr(c, 'co_code') else repr(c)
+            for c in code.co_consts]
+  return (code.co_code, consts, code.co_names)
+
+
+def _fill_features(img, out, feature_fns, feature_dims):
+  """ write the concatenated features of a single image into out """
+  idx = 0
+  for feature_fn, feature_dim in zip(feature_fns, feature_dims):
+    next_idx = idx + feature_dim
+    out[idx:next_idx] = feature_fn(img.squeeze())
+    idx = next_idx
+
+
+# State of an extract_features worker process, set by _init_feature_worker
+_feature_worker = {}
+
+
+def _init_feature_worker(shared, shape, imgs, feature_fns, feature_dims):
+  _feature_worker['out'] = np.frombuffer(shared).reshape(shape)
+  if isinstance(imgs, tuple):
+    shared_imgs, dtype, imgs_shape = imgs
+    imgs = np.frombuffer(shared_imgs, dtype=dtype, count=int(np.prod(
+        imgs_shape))).reshape(imgs_shape)
+  _feature_worker['imgs'] = imgs
+  _feature_worker['feature_fns'] = feature_fns
+  _feature_worker['feature_dims'] = feature_dims
+
+
+def _extract_feature_chunk(args):
+  """ extract the features of the images in rows start to end """
+  start, end = args
+  imgs = _feature_worker['imgs']
+  out = _feature_worker['out']
+  for i in xrange(start, end):
+    _fill_features(imgs[i], out[i], _feature_worker['feature_fns'],
+                   _feature_worker['feature_dims'])
+  return end - start
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -91,7 +413,7 @@ def hog_feature(im):
   if im.ndim == 3:
     image = rgb2gray(im)
   else:
-    image = np.at_least_2d(im)
+    image = np.atleast_2d(im)
 
   sx, sy = image.shape # image size
   orientations = 9 # number of gradient bins
@@ -118,11 +440,76 @@ def hog_feature(im):
     # select magnitudes for those orientations
     cond2 = temp_ori > 0
     temp_mag = np.where(cond2, grad_mag, 0)
-    orientation_histogram[:,:,i] = uniform_filter(temp_mag, size=(cx, cy))[cx/2::cx, cy/2::cy].T
+    orientation_histogram[:,:,i] = uniform_filter(temp_mag, size=(cx, cy))[cx//2::cx, cy//2::cy].T
   
   return orientation_histogram.ravel()
 
 
+def hog_features(imgs, chunk_size=1000):
+  """Compute Histogram of Gradient (HOG) features for a batch of images
+
+     Produces the same feature vectors as calling hog_feature on each image,
+     but processes the images chunk_size at a time with vectorized
+     operations: gradients and orientations are computed for the whole
+     chunk at once, and all orientation bins of all cells are pooled with a
+     single bincount instead of one uniform_filter per orientation.
+
+    Parameters:
+      imgs : N x H x W x C array of rgb images, or N x H x W array of
+        grayscale images
+
+    Returns:
+      feats: N x F array whose ith row is the HOG feature of imgs[i]
+
+  """
+  num_images = imgs.shape[0]
+  sx, sy = imgs.shape[1:3] # image size
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+  bin_width = 180 / orientations
+
+  # flat (cell x, cell y) index of every pixel in the cropped cell grid
+  cell_rows = np.arange(n_cellsx * cx) // cx
+  cell_cols = np.arange(n_cellsy * cy) // cy
+  cell_index = (cell_rows[:, None] * n_cellsy + cell_cols[None, :]) * orientations
+  hist_size = n_cellsx * n_cellsy * orientations
+
+  feats = np.zeros((num_images, hist_size))
+  for start in range(0, num_images, chunk_size):
+    chunk = imgs[start:start + chunk_size]
+    n = chunk.shape[0]
+    # convert rgb to grayscale if needed
+    image = rgb2gray(chunk) if chunk.ndim == 4 else chunk.astype(np.float64)
+
+    gx = np.zeros(image.shape)
+    gy = np.zeros(image.shape)
+    gx[:, :, :-1] = np.diff(image, n=1, axis=2) # gradient on x-direction
+    gy[:, :-1, :] = np.diff(image, n=1, axis=1) # gradient on y-direction
+    gx = gx[:, :n_cellsx * cx, :n_cellsy * cy]
+    gy = gy[:, :n_cellsx * cx, :n_cellsy * cy]
+    grad_mag = np.sqrt(gx ** 2 + gy ** 2)
+    grad_ori = np.arctan2(gy, (gx + 1e-15)) * (180 / np.pi) + 90
+
+    # orientation bin i holds bin_width * i <= grad_ori < bin_width * (i + 1),
+    # with grad_ori == 0 left out, exactly as in hog_feature
+    ori_bin = np.floor(grad_ori / bin_width).astype(np.int64)
+    ori_bin -= grad_ori < bin_width * ori_bin
+    ori_bin += grad_ori >= bin_width * (ori_bin + 1)
+    valid = (grad_ori > 0) & (ori_bin < orientations)
+    ori_bin[~valid] = 0
+
+    index = (np.arange(n)[:, None, None] * hist_size + cell_index) + ori_bin
+    hist = np.bincount(index.ravel(), weights=(grad_mag * valid).ravel(),
+                       minlength=n * hist_size)
+    hist = hist.reshape(n, n_cellsx, n_cellsy, orientations) / (cx * cy)
+    # hog_feature orders cells with y before x
+    feats[start:start + n] = hist.transpose(0, 2, 1, 3).reshape(n, -1)
+
+  return feats
+
+
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
   Compute color histogram for an image using hue.
@@ -138,14 +525,68 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
     1D vector of length nbin giving the color histogram over the hue of the
     input image.
   """
-  ndim = im.ndim
-  bins = np.linspace(xmin, xmax, nbin+1)
-  hsv = matplotlib.colors.rgb_to_hsv(im/xmax) * xmax
-  imhist, bin_edges = np.histogram(hsv[:,:,0], bins=bins, density=normalized)
-  imhist = imhist * np.diff(bin_edges)
+  return color_histograms_hsv(im[None], nbin=nbin, xmin=xmin, xmax=xmax,
+                              normalized=normalized)[0]
+
+
+def color_histograms_hsv(imgs, nbin=10, xmin=0, xmax=255, normalized=True):
+  """
+  Compute the hue histograms of a batch of images; row i of the result is
+  color_histogram_hsv(imgs[i]). The hue of all images is computed in one
+  vectorized pass and all histograms are counted with a single bincount.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin, xmin, xmax, normalized: As for color_histogram_hsv.
+
+  Returns:
+    N x nbin array of color histograms.
+  """
+  num_images = imgs.shape[0]
+  bin_edges = np.linspace(xmin, xmax, nbin+1)
+  hue = (_rgb_to_hue(imgs / xmax) * xmax).reshape(num_images, -1)
+
+  # Bin the hues the same way np.histogram does for uniform bins, including
+  # its corrections for round-off at the bin edges.
+  in_range = (hue >= xmin) & (hue <= xmax)
+  bins = ((hue - xmin) * (nbin / (xmax - xmin))).astype(np.int64)
+  bins = np.clip(bins, 0, nbin - 1)
+  bins -= hue < bin_edges[bins]
+  bins += (hue >= bin_edges[np.minimum(bins + 1, nbin)]) & (bins != nbin - 1)
+  bins = np.clip(bins, 0, nbin - 1)
 
-  # return histogram
+  index = np.arange(num_images)[:, None] * nbin + bins
+  counts = np.bincount(index[in_range], minlength=num_images * nbin)
+  imhist = counts.reshape(num_images, nbin).astype(np.float64)
+  db = np.diff(bin_edges)
+  if normalized:
+    imhist = imhist / db / imhist.sum(axis=1, keepdims=True)
+  imhist = imhist * db
+
+  # return histograms
   return imhist
 
 
+def _rgb_to_hue(arr):
+  """
+  Hue channel of matplotlib.colors.rgb_to_hsv for an array of RGB values in
+  [0, 1] whose last dimension holds the channels; hue is in [0, 1).
+  """
+  red, green, blue = (np.asarray(arr[..., c], dtype=np.float64) for c in range(3))
+  # elementwise maximum/minimum are much faster than reducing over the short
+  # channel axis
+  arr_max = np.maximum(np.maximum(red, green), blue)
+  delta = arr_max - np.minimum(np.minimum(red, green), blue)
+  ipos = delta > 0
+  delta = np.where(ipos, delta, 1)
+  # When several channels are the maximum, blue takes precedence over green
+  # and green over red, as in matplotlib.
+  hue = np.select(
+    [ipos & (blue == arr_max), ipos & (green == arr_max), ipos & (red == arr_max)],
+    [4. + (red - green) / delta, 2. + (blue - red) / delta,
+     (green - blue) / delta],
+    default=0.)
+  return (hue / 6.0) % 1.0
+
+
 pass
@@ -7,6 +7,8 @@ import pickle as pickle
 import numpy as np
 
 from nndl import optim
+from cs231n.data_loader import PrefetchLoader, ShardedDataset, gather_batch
+from cs231n.data_loader import random_batches, epoch_batches, block_batches
 
 
 class Solver(object):
@@ -88,6 +90,14 @@ class Solver(object):
           'X_val': Array, shape (N_val, d_1, ..., d_k) of validation images
           'y_train': Array, shape (N_train,) of labels for training images
           'y_val': Array, shape (N_val,) of labels for validation images
+          X_train and X_val may also be ShardedDatasets for data that does not
+          fit in memory; y_train then defaults to the dataset's labels and
+          minibatches are drawn a few shards at a time (see
+          ShardedDataset.batch_indices) whatever the sampling option.
+          It may also contain 'mean_image', which is subtracted from
+          minibatches of integer (e.g. uint8 memory mapped) images after they
+          are converted to float, unless 'subtract_mean' is also given and
+          False, as load_tiny_imagenet(subtract_mean=False) returns.
 
         Optional arguments:
         - update_rule: A string giving the name of an update rule in optim.py.
@@ -111,12 +121,32 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - prefetch: If positive, minibatches are gathered on a background
+          thread by a PrefetchLoader that keeps this many batches ready ahead
+          of the training loop. Default is 0, which gathers each minibatch on
+          the main thread.
+        - sampling: How minibatches are drawn from the training set. 'random'
+          (the default) samples each minibatch with replacement; 'epoch'
+          shuffles the training set once per epoch and visits every example
+          once; 'block' does the same but shuffles contiguous blocks of
+          examples, keeping reads from memory mapped data nearly sequential.
+        - block_size: Number of examples per block for 'block' sampling;
+          default is 10 * batch_size.
+        - augment: If not None, a function called as augment(X_batch, y_batch)
+          on every training minibatch before it is passed to model.loss, which
+          returns the minibatch to train on; see cs231n.augmentation. With
+          prefetch it runs on the background thread.
         """
         self.model = model
         self.X_train = data['X_train']
-        self.y_train = data['y_train']
+        self.y_train = data.get('y_train')
+        if self.y_train is None and isinstance(self.X_train, ShardedDataset):
+            self.y_train = self.X_train.y
         self.X_val = data['X_val']
         self.y_val = data['y_val']
+        self.mean_image = None
+        if data.get('subtract_mean', True):
+            self.mean_image = data.get('mean_image')
 
         # Unpack keyword arguments
         self.update_rule = kwargs.pop('update_rule', 'sgd')
@@ -130,6 +160,10 @@ class Solver(object):
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.prefetch = kwargs.pop('prefetch', 0)
+        self.sampling = kwargs.pop('sampling', 'random')
+        self.block_size = kwargs.pop('block_size', None)
+        self.augment = kwargs.pop('augment', None)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -142,6 +176,9 @@ class Solver(object):
             raise ValueError('Invalid update_rule "%s"' % self.update_rule)
         self.update_rule = getattr(optim, self.update_rule)
 
+        if self.sampling not in ('random', 'epoch', 'block'):
+            raise ValueError('Invalid sampling "%s"' % self.sampling)
+
         self._reset()
 
 
@@ -157,6 +194,17 @@ class Solver(object):
         self.loss_history = []
         self.train_acc_history = []
         self.val_acc_history = []
+        self._loader = None
+        self._batches = self._sample_batches(np.random)
+
+        # Minibatches are gathered into these buffers, which are reused on
+        # every step.
+        batch_dtype = self.X_train.dtype
+        if np.issubdtype(batch_dtype, np.integer):
+            batch_dtype = getattr(self.model, 'dtype', np.float64)
+        self._X_batch = np.empty((self.batch_size,) + self.X_train.shape[1:],
+                                 dtype=batch_dtype)
+        self._y_batch = np.empty(self.batch_size, dtype=self.y_train.dtype)
 
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
@@ -171,10 +219,16 @@ class Solver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        if self._loader is not None:
+            X_batch, y_batch = next(self._loader)
+        else:
+            batch_mask = next(self._batches)
+            n = len(batch_mask)
+            X_batch, y_batch = self._X_batch[:n], self._y_batch[:n]
+            gather_batch(self.X_train, self.y_train, batch_mask, X_batch,
+                         y_batch, self.mean_image)
+            if self.augment is not None:
+                X_batch, y_batch = self.augment(X_batch, y_batch)
 
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
@@ -189,6 +243,35 @@ class Solver(object):
             self.optim_configs[p] = next_config
 
 
+    def _sample_batches(self, rng):
+        """
+        Return a generator of minibatch indices drawn from rng according to
+        self.sampling.
+        """
+        num_train = self.X_train.shape[0]
+        if isinstance(self.X_train, ShardedDataset):
+            return self.X_train.batch_indices(rng, self.batch_size)
+        if self.sampling == 'epoch':
+            return epoch_batches(rng, num_train, self.batch_size)
+        if self.sampling == 'block':
+            return block_batches(rng, num_train, self.batch_size,
+                                 self.block_size)
+        return random_batches(rng, num_train, self.batch_size)
+
+
+    def _as_float(self, X):
+        """
+        Convert a minibatch of integer data, such as the uint8 images returned
+        by load_CIFAR10(mmap=True), to the model's dtype and subtract the mean
+        image if one was given. Floating point data is returned unchanged.
+        """
+        if np.issubdtype(X.dtype, np.integer):
+            X = X.astype(getattr(self.model, 'dtype', np.float64))
+            if self.mean_image is not None:
+                X -= self.mean_image
+        return X
+
+
     def _save_checkpoint(self):
         if self.checkpoint_name is None: return
         checkpoint = {
@@ -244,7 +327,7 @@ class Solver(object):
         for i in range(num_batches):
             start = i * batch_size
             end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
+            scores = self.model.loss(self._as_float(X[start:end]))
             y_pred.append(np.argmax(scores, axis=1))
         y_pred = np.hstack(y_pred)
         acc = np.mean(y_pred == y)
@@ -260,45 +343,60 @@ class Solver(object):
         iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
-        for t in range(num_iterations):
-            self._step()
-
-            # Maybe print training loss
-            if self.verbose and t % self.print_every == 0:
-                print('(Iteration %d / %d) loss: %f' % (
-                       t + 1, num_iterations, self.loss_history[-1]))
-
-            # At the end of every epoch, increment the epoch counter and decay
-            # the learning rate.
-            epoch_end = (t + 1) % iterations_per_epoch == 0
-            if epoch_end:
-                self.epoch += 1
-                for k in self.optim_configs:
-                    self.optim_configs[k]['learning_rate'] *= self.lr_decay
-
-            # Check train and val accuracy on the first iteration, the last
-            # iteration, and at the end of each epoch.
-            first_it = (t == 0)
-            last_it = (t == num_iterations - 1)
-            if first_it or last_it or epoch_end:
-                train_acc = self.check_accuracy(self.X_train, self.y_train,
-                    num_samples=self.num_train_samples)
-                val_acc = self.check_accuracy(self.X_val, self.y_val,
-                    num_samples=self.num_val_samples)
-                self.train_acc_history.append(train_acc)
-                self.val_acc_history.append(val_acc)
-                self._save_checkpoint()
-
-                if self.verbose:
-                    print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
-                           self.epoch, self.num_epochs, train_acc, val_acc))
-
-                # Keep track of the best model
-                if val_acc > self.best_val_acc:
-                    self.best_val_acc = val_acc
-                    self.best_params = {}
-                    for k, v in self.model.params.items():
-                        self.best_params[k] = v.copy()
+        if self.prefetch > 0:
+            # The background thread draws from its own RandomState (seeded
+            # from the global one) so runs stay reproducible.
+            rng = np.random.RandomState(np.random.randint(2 ** 31 - 1))
+            self._loader = PrefetchLoader(
+                self.X_train, self.y_train, self._sample_batches(rng),
+                self.batch_size, prefetch=self.prefetch,
+                dtype=self._X_batch.dtype, mean_image=self.mean_image,
+                transform=self.augment)
+
+        try:
+            for t in range(num_iterations):
+                self._step()
+
+                # Maybe print training loss
+                if self.verbose and t % self.print_every == 0:
+                    print('(Iteration %d / %d) loss: %f' % (
+                           t + 1, num_iterations, self.loss_history[-1]))
+
+                # At the end of every epoch, increment the epoch counter and
+                # decay the learning rate.
+                epoch_end = (t + 1) % iterations_per_epoch == 0
+                if epoch_end:
+                    self.epoch += 1
+                    for k in self.optim_configs:
+                        self.optim_configs[k]['learning_rate'] *= self.lr_decay
+
+                # Check train and val accuracy on the first iteration, the last
+                # iteration, and at the end of each epoch.
+                first_it = (t == 0)
+                last_it = (t == num_iterations - 1)
+                if first_it or last_it or epoch_end:
+                    train_acc = self.check_accuracy(self.X_train, self.y_train,
+                        num_samples=self.num_train_samples)
+                    val_acc = self.check_accuracy(self.X_val, self.y_val,
+                        num_samples=self.num_val_samples)
+                    self.train_acc_history.append(train_acc)
+                    self.val_acc_history.append(val_acc)
+                    self._save_checkpoint()
+
+                    if self.verbose:
+                        print('(Epoch %d / %d) train acc: %f; val_acc: %f' % (
+                               self.epoch, self.num_epochs, train_acc, val_acc))
+
+                    # Keep track of the best model
+                    if val_acc > self.best_val_acc:
+                        self.best_val_acc = val_acc
+                        self.best_params = {}
+                        for k, v in self.model.params.items():
+                            self.best_params[k] = v.copy()
+        finally:
+            if self._loader is not None:
+                self._loader.close()
+                self._loader = None
 
         # At the end of training swap the best params into the model
         self.model.params = self.best_params